@@ -2,13 +2,20 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
 
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
 import pandas as pd
 pd.options.mode.chained_assignment = None
 
 import json
 
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','Scripts','Common'))
+from burst_ring import open_ring
+from bus_schema import read_buses_csv, schema_dtypes
+
 import plotly.graph_objects as go
 import plotly.io as pio
 
@@ -74,6 +81,10 @@ max_ttls = {
 
 box_height = '33.3vh'
 
+#Seconds between checks of the last burst in the rings, and between reads of the files without them
+RING_POLL = 1
+FILES_REFRESH = 30
+
 # WE LOAD THE DATA
 stops = pd.read_csv('../Data/Static/stops.csv')
 lines_shapes = pd.read_csv('../Data/Static/lines_shapes.csv')
@@ -144,9 +155,11 @@ layout = html.Div(className = '', children = [
         ])
     ]),
     html.Div(id='hidden-div', style={'display':'none'}),
+    #Id of the last burst processed, the graphs are updated when it changes
+    html.Div(id='last-burst-id', style={'display':'none'}),
     dcc.Interval(
         id='interval-component',
-        interval=30*1000, # in milliseconds
+        interval=RING_POLL*1000, # in milliseconds
         n_intervals=0
     )
 ])
@@ -157,52 +170,44 @@ style = 'mapbox://styles/alejp1998/ck9voa0bb002y1ipcx8j00oeu'
 pio.templates.default = 'plotly_white'
 
 
+#Rings written by the detector
+bursts_c_ring = open_ring('bursts_c')
+headways_ring = open_ring('headways')
+
 # FUNCTIONS
-def read_df(name) :
+def read_df(name,last_burst=None) :
+    #Bursts processed from the shared rings, if the detector writes them. The cleaned
+    #burst and its headways are read with the same id, so they belong to the same burst
+    if name in ['burst','hws_burst'] :
+        burst_id = last_burst if isinstance(last_burst,int) else headways_ring.last_id()
+        if burst_id != None :
+            if name == 'burst' :
+                df = bursts_c_ring.read(burst_id)
+                if df is not None :
+                    return df
+            else :
+                df = headways_ring.read(burst_id)
+                if df is not None :
+                    return df[['line','direction','datetime','hw_pos','busA','busB','headway','busB_ttls']]
+
     if name == 'burst' :
         #Read last burst of data
-        df = pd.read_csv('../Data/RealTime/buses_data_burst_c.csv',
-            dtype={
-                'line': 'str',
-                'destination': 'str',
-                'stop': 'uint16',
-                'bus': 'uint16',
-                'given_coords': 'bool',
-                'pos_in_burst':'uint16',
-                'estimateArrive': 'int32',
-                'DistanceBus': 'int32',
-                'request_time': 'int32',
-                'lat':'float32',
-                'lon':'float32'
-            }
-        )[['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']]
-        #Parse the dates
-        df['datetime'] = pd.to_datetime(df['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
+        df = read_buses_csv('../Data/RealTime/buses_data_burst_c.csv',
+            ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus'])
     elif name == 'hws_burst' :
         #Read last processed headways
-        df = pd.read_csv('../Data/RealTime/headways_burst.csv',
-            dtype={
-                'line': 'str',
-                'direction': 'uint16',
-                'busA': 'uint16',
-                'busB': 'uint16',
-                'headway':'int16',
-                'busB_ttls':'uint16'
-            }
-        )[['line','direction','datetime','hw_pos','busA','busB','headway','busB_ttls']]
+        df = read_buses_csv('../Data/RealTime/headways_burst.csv',
+            ['line','direction','datetime','hw_pos','busA','busB','headway','busB_ttls'],
+            date_format=None)
     elif name == 'series' :
         #Read last series data
         df = pd.read_csv('../Data/RealTime/series.csv',
-            dtype={
-                'line': 'str'
-            }
+            dtype=schema_dtypes(['line'])
         )
     elif name =='anomalies' :
         #Read last anomalies data
         df = pd.read_csv('../Data/Anomalies/anomalies.csv',
-            dtype={
-                'line': 'str'
-            }
+            dtype=schema_dtypes(['line'])
         )
     return df
 
@@ -936,22 +941,40 @@ def build_anoms_table(anomalies_df) :
 
 # CALLBACKS
 
+# CALLBACK 0 - Last burst processed
+@app.callback(
+    [Output('last-burst-id','children')],
+    [Input('interval-component','n_intervals')],
+    [State('last-burst-id','children')]
+)
+def update_last_burst(n_intervals,last_burst) :
+    #The detector writes the headways after the cleaned burst, both rings have the last one
+    last_id = headways_ring.last_id()
+    if last_id == None :
+        #Without the rings the files are read again every FILES_REFRESH seconds
+        if (n_intervals*RING_POLL) % FILES_REFRESH != 0 :
+            raise PreventUpdate
+        return ['files {}'.format(n_intervals)]
+    if last_id == last_burst :
+        raise PreventUpdate
+    return [last_id]
+
 # CALLBACK 0a - New interval loading
 @app.callback(
     [Output('new-interval-loading','children')],
-    [Input('interval-component','n_intervals'),Input('update-button','n_clicks')]
+    [Input('last-burst-id','children'),Input('update-button','n_clicks')]
 )
-def new_interval(n_intervals,n_clicks) :
+def new_interval(last_burst,n_clicks) :
 
     return [html.H1('Loading',style={'display':'none'})]
 
 # CALLBACK 0a - Title and sliders
 @app.callback(
     [Output('tab-title','children'),Output('conf','children'),Output('size-th','children')],
-    [Input('interval-component','n_intervals'),Input('update-button','n_clicks'),
+    [Input('last-burst-id','children'),Input('update-button','n_clicks'),
     Input('url', 'pathname')]
 )
-def update_title_sliders(n_intervals,n_clicks,pathname) :
+def update_title_sliders(last_burst,n_clicks,pathname) :
     line = pathname[10:]
     
     now = dt.now()
@@ -1033,13 +1056,13 @@ def update_hyperparams(conf,size_th,pathname) :
         Output('buses-pos-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname'),
         Input('flat-hws','clickData')
     ]
 )
-def update_buses_position(n_intervals,n_clicks,pathname,hoverData) :
+def update_buses_position(last_burst,n_clicks,pathname,hoverData) :
 
     line = pathname[10:]
 
@@ -1047,7 +1070,7 @@ def update_buses_position(n_intervals,n_clicks,pathname,hoverData) :
         if 'text' in hoverData['points'][0].keys() :
             hover_buses = [int(hoverData['points'][0]['text'].split('<b>Bus: ')[1].split('</b>')[0])]
         else :
-            hws_burst = read_df('hws_burst')
+            hws_burst = read_df('hws_burst',last_burst)
 
             dest = hoverData['points'][0]['y'][3:-1]
             x = hoverData['points'][0]['x']
@@ -1061,7 +1084,7 @@ def update_buses_position(n_intervals,n_clicks,pathname,hoverData) :
     except :
         hover_buses = None
 
-    burst = read_df('burst')
+    burst = read_df('burst',last_burst)
 
     #Line dataframe
     line_burst = burst.loc[burst.line == line]
@@ -1096,15 +1119,15 @@ def update_buses_position(n_intervals,n_clicks,pathname,hoverData) :
         Output('flat-hws-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname')
     ]
 )
-def update_flat_hws(n_intervals,n_clicks,pathname) :
+def update_flat_hws(last_burst,n_clicks,pathname) :
     line = pathname[10:]
 
-    hws_burst = read_df('hws_burst')
+    hws_burst = read_df('hws_burst',last_burst)
 
     line_hws = hws_burst.loc[hws_burst.line == line]
 
@@ -1132,20 +1155,20 @@ def update_flat_hws(n_intervals,n_clicks,pathname) :
         Output('time-series-hws-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname'),
         Input('flat-hws','clickData')
     ]
 )
-def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
+def update_time_series_hws(last_burst,n_clicks,pathname,hoverData) :
     line = pathname[10:]
 
     try :
         if 'text' in hoverData['points'][0].keys() :
             hover_buses = [int(hoverData['points'][0]['text'].split('<b>Bus: ')[1].split('</b>')[0])]
         else :
-            hws_burst = read_df('hws_burst')
+            hws_burst = read_df('hws_burst',last_burst)
 
             dest = hoverData['points'][0]['y'][3:-1]
             x = hoverData['points'][0]['x']
@@ -1218,7 +1241,7 @@ def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
         }
     )
 
-    #if n_intervals == 0 :
+    #if last_burst == None :
         #graph = dcc.Loading(type='cube',children = [graph])
 
     #And return all of them
@@ -1231,20 +1254,20 @@ def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
         Output('2d-time-series-hws-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname'),
         Input('flat-hws','clickData')
     ]
 )
-def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
+def update_time_series_hws(last_burst,n_clicks,pathname,hoverData) :
     line = pathname[10:]
 
     try :
         if 'text' in hoverData['points'][0].keys() :
             hover_buses = [int(hoverData['points'][0]['text'].split('<b>Bus: ')[1].split('</b>')[0])]
         else :
-            hws_burst = read_df('hws_burst')
+            hws_burst = read_df('hws_burst',last_burst)
 
             dest = hoverData['points'][0]['y'][3:-1]
             x = hoverData['points'][0]['x']
@@ -1322,7 +1345,7 @@ def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
         }
     )
 
-    #if n_intervals == 0 :
+    #if last_burst == None :
         #graph = dcc.Loading(type='cube',children = [graph])
 
     #And return all of them
@@ -1335,13 +1358,13 @@ def update_time_series_hws(n_intervals,n_clicks,pathname,hoverData) :
         Output('mdist-hws-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname'),
         Input('flat-hws','clickData')
     ]
 )
-def update_mdist_series(n_intervals,n_clicks,pathname,hoverData) :
+def update_mdist_series(last_burst,n_clicks,pathname,hoverData) :
     try :
         line = pathname[10:]
 
@@ -1350,7 +1373,7 @@ def update_mdist_series(n_intervals,n_clicks,pathname,hoverData) :
             if 'text' in hoverData['points'][0].keys() :
                 hover_buses = [int(hoverData['points'][0]['text'].split('<b>Bus: ')[1].split('</b>')[0])]
             else :
-                hws_burst = read_df('hws_burst')
+                hws_burst = read_df('hws_burst',last_burst)
 
                 dest = hoverData['points'][0]['y'][3:-1]
                 x = hoverData['points'][0]['x']
@@ -1401,7 +1424,7 @@ def update_mdist_series(n_intervals,n_clicks,pathname,hoverData) :
             }
         )
         
-        #if n_intervals == 0 :
+        #if last_burst == None :
             #graph = dcc.Loading(type='cube',children = [graph])
 
         #And return all of them
@@ -1416,12 +1439,12 @@ def update_mdist_series(n_intervals,n_clicks,pathname,hoverData) :
         Output('anom-hws-div','children')
     ],
     [
-        Input('interval-component','n_intervals'),
+        Input('last-burst-id','children'),
         Input('update-button','n_clicks'),
         Input('url', 'pathname')
     ]
 )
-def update_anomalies_table(n_intervals,n_clicks,pathname) :
+def update_anomalies_table(last_burst,n_clicks,pathname) :
     line = pathname[10:]
 
     anomalies = read_df('anomalies')
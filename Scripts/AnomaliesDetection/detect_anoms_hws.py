@@ -16,8 +16,15 @@ import os.path
 
 import time
 
+import sys
 from sys import argv
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Common'))
+from burst_ring import open_ring
+from cleaning import clean_data
+from bus_schema import read_buses_csv, to_schema, schema_dtypes
+from trip_profiles import load_trip_profiles, headway_stops
+
 #Lines to iterate over
 lines = ['1','44','82','132','133']
 #Day types to iterate over
@@ -25,6 +32,9 @@ day_types = ['LA','SA','FE']
 #Hour ranges to iterate over
 #hour_ranges = [[7,11], [11,15], [15,19], [19,23]]
 hour_ranges = [[i,i+1] for i in range(7,23)]
+#Seconds between looks for a new burst, doubled while none arrives up to the max
+MIN_IDLE_SLEEP = 0.2
+MAX_IDLE_SLEEP = 5
 
 
 #Lines collected dictionary
@@ -33,71 +43,14 @@ with open('../../Data/Static/lines_collected_dict.json', 'r') as f:
 #Models parameters dictionary
 with open('../../Data/Anomalies/models_params.json', 'r') as f:
     models_params_dict = json.load(f)
-#Load times between stops data
-times_bt_stops = pd.read_csv('../../Data/Processed/times_bt_stops.csv',
-    dtype={
-        'line': 'str',
-        'direction': 'uint16',
-        'st_hour': 'uint16',
-        'end_hour': 'uint16',
-        'stopA': 'uint16',
-        'stopB': 'uint16',
-        'bus': 'uint16',
-        'trip_time':'float32',
-        'api_trip_time':'float32'
-    }
-)
-#Parse the dates
-times_bt_stops['date'] = pd.to_datetime(times_bt_stops['date'], format='%Y-%m-%d')
-
-
-#Day types
-day_type_dict = { #0 = Monday, 1 = Tuesday ...
-    'LA' : [0,1,2,3,4], #LABORABLES
-    'LJ' : [0,1,2,3], #LUNES A JUEVES
-    'VV' : [4], #VIERNES
-    'SA' : [5], #SABADOS
-    'FE' : [6], #DOMIGOS O FESTIVOS
-}
+#Mean trip times between stops
+trip_profiles = load_trip_profiles()
 
 #Bus and headways column names
 bus_names_all = ['bus' + str(i) for i in range(1,8+2)]
 hw_names_all = ['hw' + str(i) + str(i+1) for i in range(1,8+1)]
 
 
-def clean_data(df) :
-    def check_conditions(row) :
-        #Direction
-        direction = '1' if row.destination == lines_collected_dict[row.line]['destinations'][1] else '2'
-
-        #Line destination stop coherence condition
-        line_dest_stop_cond = False
-        if row.line in lines_collected_dict.keys() :
-            if row.destination in lines_collected_dict[row.line]['destinations'] :
-                if str(row.stop) in lines_collected_dict[row.line][direction]['stops'] :
-                    line_dest_stop_cond = True
-
-        # DistanceBus values lower than the line length or negative
-        dist_cond = (row.DistanceBus >= 0) and \
-                    (row.DistanceBus < int(lines_collected_dict[row.line][direction]['length']))
-
-        # estimateArrive values lower than the time it takes to go through the line at an speed
-        # of 2m/s, instantaneous speed lower than 120 km/h and positive values and time remaining lower than 2 hours
-        eta_cond = (row.estimateArrive > 0) and \
-                   (row.estimateArrive < (int(lines_collected_dict[row.line][direction]['length'])/2)) and \
-                   ((3.6*row.DistanceBus/row.estimateArrive) < 120) & \
-                   (row.estimateArrive < 7200)
-
-        return line_dest_stop_cond and dist_cond and eta_cond
-
-    #Check conditions in df
-    mask = df.apply(check_conditions,axis=1)
-    #Select rows that match the conditions
-    df = df.loc[mask].reset_index(drop=True)
-    #Return cleaned DataFrame
-    return df
-
-
 #For every burst of data:
 def process_headways(int_df,day_type,hour_range,ap_order_dict) :
     rows_list = []
@@ -109,8 +62,7 @@ def process_headways(int_df,day_type,hour_range,ap_order_dict) :
     line = int_df.iloc[0].line
 
     #Stops of each line reversed
-    stops1 = lines_collected_dict[line]['1']['stops'][-2::-1][0:-2]
-    stops2 = lines_collected_dict[line]['2']['stops'][-2::-1][0:-2]
+    stops1,stops2 = headway_stops(line)
 
     #Appearance order buses list
     ap_order_dir1 = ap_order_dict[line]['dir1']
@@ -123,34 +75,19 @@ def process_headways(int_df,day_type,hour_range,ap_order_dict) :
     #Assign destination values
     dest2,dest1 = lines_collected_dict[line]['destinations']
 
-    #Process mean times between stops
-    tims_bt_stops = times_bt_stops.loc[(times_bt_stops.line == line) & \
-                                        (times_bt_stops.date.dt.weekday.isin(day_type_dict[day_type])) & \
-                                        (times_bt_stops.st_hour >= hour_range[0]) & \
-                                        (times_bt_stops.st_hour < hour_range[1])]
-    #Group and get the mean values
-    tims_bt_stops = tims_bt_stops.groupby(['line','direction','stopA','stopB']).mean()
-    tims_bt_stops = tims_bt_stops.reset_index()[['line','direction','stopA','stopB','trip_time','api_trip_time']]
+    #Mean times from the stops to the first one
+    times_to_stops = trip_profiles.times_to_stops(line,day_type,hour_range)
 
     #All stops of the line
     stops = stops1 + stops2
     stop_df_list = []
     buses_out1,buses_out2 = [],[]
     dest,direction = dest1,1
-    for i in range(len(stops)) :
+    for i in range(len(times_to_stops)) :
         stop = stops[i]
-        if i == 0 :
-            mean_time_to_stop = 0
-        elif i == len(stops1) :
-            mean_time_to_stop = 0
+        mean_time_to_stop = times_to_stops[i]
+        if i == len(stops1) :
             dest,direction = dest2,2
-        else :
-            mean_df = tims_bt_stops.loc[(tims_bt_stops.stopA == int(stop)) & \
-                            (tims_bt_stops.direction == direction)]
-            if mean_df.shape[0] > 0 :
-                mean_time_to_stop += mean_df.iloc[0].trip_time
-            else :
-                break
 
         stop_df = int_df.loc[(int_df.stop == int(stop)) & \
                             (int_df.destination == dest)]
@@ -178,7 +115,7 @@ def process_headways(int_df,day_type,hour_range,ap_order_dict) :
     stops_df = pd.concat(stop_df_list)
 
     #Group by bus and destination
-    stops_df = stops_df.groupby(['bus','destination']).mean().sort_values(by=['estimateArrive'])
+    stops_df = stops_df.groupby(['bus','destination'],observed=True).mean().sort_values(by=['estimateArrive'])
     stops_df = stops_df.reset_index().drop_duplicates('bus',keep='first')
     #Loc buses not given by first stop
     stops_df = stops_df.loc[((stops_df.destination == dest1) & (~stops_df.bus.isin(buses_out1))) | \
@@ -483,6 +420,8 @@ def process_hws_ndim_mh_dist(lines,day_type,hour_range,burst_df,ap_order_dict) :
         windows_df = pd.concat(windows_dfs)
     else :
         windows_df = pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom'] + bus_names_all + hw_names_all)
+    #Lines as categories, like the series they are appended to
+    windows_df = windows_df.astype(schema_dtypes(['line']))
 
     return headways_df,windows_df,ap_order_dict
 
@@ -540,7 +479,8 @@ def build_series_anoms(series_df,windows_df) :
     else : 
         new_series_df = pd.DataFrame(columns=['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all)
 
-    series_df = series_df.append(new_series_df, ignore_index=True)
+    #Same categories as the past series, appending strings would turn the lines into objects
+    series_df = series_df.append(new_series_df.astype(schema_dtypes(['line'])), ignore_index=True)
 
     return series_df,anomalies_dfs
 
@@ -580,7 +520,7 @@ def clean_series(series_df,anomalies_dfs,now) :
     return series_df,anomalies_dfs
 
 
-def detect_anomalies(burst_df,last_burst_df,series_df,ap_order_dict) :
+def detect_anomalies(burst_df,series_df,ap_order_dict) :
     #Read dict
     while True :
         try :
@@ -590,11 +530,6 @@ def detect_anomalies(burst_df,last_burst_df,series_df,ap_order_dict) :
         except: 
             continue
 
-    #Check if the burst dataframe has changed
-    if last_burst_df.equals(burst_df) :
-        #If it hasnt changed we return None
-        return None
-
     #Detect day type and hour range from current datetime
     now = dt.now()
     #Day type
@@ -626,7 +561,7 @@ def detect_anomalies(burst_df,last_burst_df,series_df,ap_order_dict) :
     series_df = series_df.reset_index(drop=True)
     
     #Build anomalies dataframe
-    anomalies_df = pd.concat(anomalies_dfs).drop('anom',axis=1) if len(anomalies_dfs) > 0 else pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom_size'] + bus_names_all + hw_names_all)
+    anomalies_df = pd.concat(anomalies_dfs).drop('anom',axis=1) if len(anomalies_dfs) > 0 else pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom_size'] + bus_names_all + hw_names_all).astype(schema_dtypes(['line']))
     
     #Get anomalies with size over threshold
     lines_anomalies = []
@@ -644,25 +579,80 @@ def detect_anomalies(burst_df,last_burst_df,series_df,ap_order_dict) :
     return headways_df,series_df,anomalies_df,ap_order_dict
 
 
+def read_burst_manifest() :
+    '''
+    Returns the manifest of the last burst published by the collector
+    '''
+    with open('../../Data/RealTime/buses_data_burst.json', 'r') as f:
+        return json.load(f)
+
+
+def read_burst(name) :
+    '''
+    Returns the burst of data published by the collector
+
+    Parameters
+    ----------------
+    name : str
+        Name of the burst file given by the manifest, feather or csv
+    '''
+    f = '../../Data/RealTime/' + name
+    columns = ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']
+    if f.endswith('.feather') :
+        burst_df = to_schema(pd.read_feather(f, columns=columns))
+    else :
+        burst_df = read_buses_csv(f, columns)
+    return burst_df
+
+
+def read_last_burst(bursts_ring,last_burst_id) :
+    '''
+    Returns the id and the data of the last burst published by the collector,
+    from the shared ring or from the burst file if the ring is not available.
+    The data is None if there is no new burst to process
+
+    Parameters
+    ----------------
+    bursts_ring : BurstRing
+        Ring where the collector writes the bursts
+    last_burst_id : int
+        Id of the last burst processed
+    '''
+    burst_id = bursts_ring.last_id()
+    if burst_id is not None :
+        if burst_id == last_burst_id :
+            return burst_id,None
+        burst_df = bursts_ring.read(burst_id)
+        if burst_df is not None :
+            return burst_id,burst_df
+
+    #Skip the burst if it has already been processed
+    manifest = read_burst_manifest()
+    if manifest['burst_id'] == last_burst_id :
+        return last_burst_id,None
+
+    #Read last burst of data
+    burst_df = read_burst(manifest['file'])
+
+    #Read it again if a new burst was published while reading
+    if read_burst_manifest()['burst_id'] != manifest['burst_id'] :
+        return last_burst_id,None
+    return manifest['burst_id'],burst_df
+
+
 def main():
     try :
         #Read last series data
-        series_df = pd.read_csv('../../Data/RealTime/series.csv',
-            dtype={
-                'line': 'str'
-            }
-        )
-        #Parse the dates
-        series_df['datetime'] = pd.to_datetime(series_df['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
-        series_df = series_df[['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all]
+        series_df = read_buses_csv('../../Data/RealTime/series.csv',
+            ['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all)
 
         if (dt.now() - series_df.iloc[-1].datetime).total_seconds() > 600 :
             #Initialize dataframes
-            series_df = pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all)
+            series_df = pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all).astype(schema_dtypes(['line']))
     
     except:
         #Initialize dataframes
-        series_df = pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all)
+        series_df = pd.DataFrame(columns = ['line','datetime','dim','m_dist','anom','anom_size'] + bus_names_all + hw_names_all).astype(schema_dtypes(['line']))
 
     #Create dict
     ap_order_dict = {}
@@ -676,35 +666,26 @@ def main():
             'cons_ap2': {}
         }
 
-    last_burst_df = pd.DataFrame(columns = ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus'])
+    last_burst_id = None
+    #Rings shared with the collector and the dashboard
+    bursts_ring = open_ring('bursts')
+    bursts_c_ring = open_ring('bursts_c')
+    headways_ring = open_ring('headways')
 
     #Inform of the selected parameters
     print('\n----- Detecting anomalies and preprocessing server data -----\n')
 
-    #Look for updated data every 5 seconds
+    #Look for updated data every 200 milliseconds, less often while no burst arrives
+    idle_sleep = MIN_IDLE_SLEEP
     while True :
         try :
-            #Read last burst of data
-            burst_df = pd.read_csv('../../Data/RealTime/buses_data_burst.csv',
-                dtype={
-                    'line': 'str',
-                    'destination': 'str',
-                    'stop': 'uint16',
-                    'bus': 'uint16',
-                    'given_coords': 'bool',
-                    'pos_in_burst':'uint16',
-                    'estimateArrive': 'int32',
-                    'DistanceBus': 'int32',
-                    'request_time': 'int32',
-                    'lat':'float32',
-                    'lon':'float32'
-                }
-            )[['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']]
-
-
-            #Parse the dates
-            burst_df['datetime'] = pd.to_datetime(burst_df['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
-            
+            burst_id,burst_df = read_last_burst(bursts_ring,last_burst_id)
+            if burst_df is None :
+                time.sleep(idle_sleep)
+                idle_sleep = min(2*idle_sleep,MAX_IDLE_SLEEP)
+                continue
+            idle_sleep = MIN_IDLE_SLEEP
+
             #Clean burst df
             burst_df = clean_data(burst_df)
         except :
@@ -713,7 +694,7 @@ def main():
             continue
         
         #try :
-        result = detect_anomalies(burst_df,last_burst_df,series_df,ap_order_dict)
+        result = detect_anomalies(burst_df,series_df,ap_order_dict)
         #except :
             #result = None
         
@@ -726,6 +707,10 @@ def main():
                 #print(series_df.head(2))
                 #print(anomalies_df.head(2))
 
+                #Write new data to the shared rings
+                bursts_c_ring.write(burst_id,burst_df)
+                headways_ring.write(burst_id,headways_df)
+
                 #Write new data to files
                 f = '../../Data/'
                 burst_df.to_csv(f+'RealTime/buses_data_burst_c.csv')
@@ -745,8 +730,7 @@ def main():
             elif result == 'Wait' :
                 time.sleep(120)
 
-        last_burst_df = burst_df
-        time.sleep(5)
+        last_burst_id = burst_id
 
 if __name__== "__main__":
     main()
\ No newline at end of file
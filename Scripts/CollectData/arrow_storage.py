@@ -0,0 +1,146 @@
+import os
+import datetime
+from threading import Lock
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+#Types of the raw data columns, the same ones used to read the csv files
+raw_dtypes = {
+    'bus': 'uint16',
+    'line': 'str',
+    'stop': 'uint16',
+    'isHead': 'str',
+    'destination': 'str',
+    'deviation': 'int32',
+    'estimateArrive': 'int32',
+    'DistanceBus': 'int32',
+    'request_time': 'int32',
+    'given_coords': 'bool',
+    'lat': 'float32',
+    'lon': 'float32'
+}
+
+raw_schema = pa.schema([
+    ('bus', pa.uint16()),
+    ('line', pa.string()),
+    ('stop', pa.uint16()),
+    ('datetime', pa.timestamp('us')),
+    ('isHead', pa.string()),
+    ('destination', pa.string()),
+    ('deviation', pa.int32()),
+    ('estimateArrive', pa.int32()),
+    ('DistanceBus', pa.int32()),
+    ('request_time', pa.int32()),
+    ('given_coords', pa.bool_()),
+    ('lat', pa.float32()),
+    ('lon', pa.float32())
+])
+
+def to_raw_table(df) :
+    '''
+    Returns the Arrow table of the burst dataframe with the raw data schema
+
+    Parameters
+    ----------
+    df : DataFrame
+        Burst of data with the columns of raw_schema
+    '''
+    df = df.astype(raw_dtypes)
+    #Empty bursts have the dates column as object
+    df['datetime'] = pd.to_datetime(df['datetime'])
+    return pa.Table.from_pandas(df[raw_schema.names], schema=raw_schema, preserve_index=False)
+
+def write_burst(df, f) :
+    '''
+    Writes the burst dataframe to a typed feather file
+
+    Parameters
+    ----------
+    df : DataFrame
+        Burst of data with the columns of raw_schema
+    f : str
+        Path of the file
+    '''
+    feather.write_feather(to_raw_table(df), f)
+
+
+class DayPartitionedWriter(object):
+    '''
+    Appends the bursts of data as record batches of an Arrow IPC stream,
+    with a directory for each day of data. Every time the collector is
+    started a new part is opened, so no file is ever rewritten. The
+    streams can be read back memory mapped with pyarrow.ipc.open_stream
+    even if the collector died in the middle of the day.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.day       = None
+        self.sink      = None
+        self.writer    = None
+        self.lock      = Lock()
+
+    def write(self, df, fsync=False):
+        '''
+        Appends the bursts dataframe to the files of their days. If the write
+        fails the files are cut back to their size before it, so either every
+        burst is appended or none is
+
+        Parameters
+        ----------
+        df : DataFrame
+            One or more bursts of data with the columns of raw_schema
+        fsync : bool
+            Wait until the data is on disk
+        '''
+        if df.shape[0] == 0 :
+            return
+        with self.lock :
+            #Size of the files before the bursts were appended to them
+            sizes = []
+            try :
+                for day,day_df in df.groupby(pd.to_datetime(df['datetime']).dt.date, sort=True) :
+                    if day != self.day :
+                        self._open(day)
+                    sizes.append((self.sink.name,self.sink.tell()))
+                    self.writer.write_table(to_raw_table(day_df))
+                    self.sink.flush()
+                    if fsync :
+                        os.fsync(self.sink.fileno())
+            except :
+                self._rollback(sizes)
+                raise
+
+    def _rollback(self, sizes):
+        #The stream is left as it was, a new part is opened for the next write
+        try :
+            self.sink.close()
+        except :
+            pass
+        self.writer,self.sink,self.day = None,None,None
+        for f,size in sizes :
+            #A part is empty until its first burst, without the schema it could not be read
+            if size == 0 :
+                os.remove(f)
+            else :
+                os.truncate(f,size)
+
+    def _open(self, day):
+        self._close()
+        day_dir = os.path.join(self.directory,'date={}'.format(day.isoformat()))
+        os.makedirs(day_dir, exist_ok=True)
+        f = os.path.join(day_dir,'part-{}.arrow'.format(datetime.datetime.now().strftime('%H%M%S%f')))
+        self.sink = open(f,'wb')
+        self.writer = pa.ipc.new_stream(self.sink, raw_schema)
+        self.day = day
+
+    def _close(self):
+        if self.writer != None :
+            self.writer.close()
+            self.sink.close()
+        self.writer,self.sink,self.day = None,None,None
+
+    def close(self):
+        with self.lock :
+            self._close()
@@ -0,0 +1,100 @@
+import time
+import datetime
+from datetime import timedelta
+
+class BurstScheduler(object):
+    '''
+    Fires the bursts of the collector inside the service windows. The next
+    burst is due an interval after the previous one was due, and it is
+    only fired once the previous one has finished, so bursts never overlap.
+    When a burst takes longer than the interval the ticks already missed
+    are skipped instead of fired one after another. Outside the windows
+    the scheduler sleeps until the next one starts.
+    '''
+    def __init__(self, windows, burst, interval, on_window_end=None):
+        '''
+        Parameters
+        ----------
+        windows : function
+            Function that receives a date and returns the list of
+            (start, end, requested_lines) service windows of that day,
+            with start and end datetimes
+        burst : function
+            Function that receives the requested lines, the seconds the tick
+            was fired late and the number of ticks skipped before it
+        interval : function
+            Function that receives the requested lines and the current
+            datetime and returns the seconds until the next burst
+        on_window_end : function
+            Function called when a service window ends
+        '''
+        self.windows       = windows
+        self.burst         = burst
+        self.interval      = interval
+        self.on_window_end = on_window_end
+
+    def current_window(self, now):
+        '''
+        Returns the service window of the current datetime, or None
+        '''
+        for window in self.windows(now.date()) :
+            if window[0] <= now < window[1] :
+                return window
+        return None
+
+    def next_window_start(self, now):
+        '''
+        Returns the datetime when the next service window starts
+        '''
+        starts = [window[0] for day in [now.date(),now.date()+timedelta(days=1)] \
+                  for window in self.windows(day) if window[0] > now]
+        return min(starts)
+
+    def _end_window(self, window):
+        print('Stop retrieving data from {} lines - {}\n'.format(len(window[2]),datetime.datetime.now()))
+        if self.on_window_end != None :
+            self.on_window_end()
+
+    def run(self):
+        window,next_fire,skipped_ticks = None,None,0
+        while True :
+            now = datetime.datetime.now()
+            current = self.current_window(now)
+
+            #Sleep until the next window starts
+            if current == None :
+                if window != None :
+                    self._end_window(window)
+                    window = None
+                time.sleep(max((self.next_window_start(now) - now).total_seconds(),1))
+                continue
+
+            #A new window starts, the first burst is due now
+            if current != window :
+                if window != None :
+                    self._end_window(window)
+                window,next_fire,skipped_ticks = current,now,0
+                print('Retrieve data from {} lines until {} - {}\n'.format(len(window[2]),window[1],now))
+
+            #Wait for the tick, or for the end of the window if it comes first
+            if now < next_fire :
+                time.sleep((min(next_fire,window[1]) - now).total_seconds())
+                continue
+
+            tick_drift = (now - next_fire).total_seconds()
+            try :
+                self.burst(window[2],tick_drift,skipped_ticks)
+            except Exception as e :
+                print('There was an error in the burst - {}'.format(datetime.datetime.now()))
+                print(e)
+                print('\n')
+
+            #Next tick, skipping the ones missed while the burst was running
+            now = datetime.datetime.now()
+            interval = self.interval(window[2],now)
+            next_fire += timedelta(seconds=interval)
+            skipped_ticks = 0
+            if next_fire < now :
+                skipped_ticks = int((now - next_fire).total_seconds() // interval) + 1
+                next_fire += timedelta(seconds=skipped_ticks*interval)
+                print('Burst took longer than the interval, {} ticks skipped - {}\n'.format(skipped_ticks,now))
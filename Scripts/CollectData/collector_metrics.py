@@ -0,0 +1,146 @@
+import json
+import time
+import datetime
+import logging
+from logging.handlers import RotatingFileHandler
+from collections import deque
+from threading import Lock
+
+from aiohttp import web
+
+#Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05,0.1,0.25,0.5,1,2.5,5,float('inf')]
+
+class BurstMetrics(object):
+    '''
+    Metrics of a single burst of the collector
+    '''
+    def __init__(self, burst):
+        self.burst         = burst
+        self.start         = time.perf_counter()
+        self.datetime      = datetime.datetime.now()
+        self.latencies     = []
+        self.request_times = []
+        self.bytes         = 0
+        self.rows          = 0
+        self.raw_rows      = 0
+        self.ok            = 0
+        self.not_ok        = 0
+        self.parse_time    = 0
+        self.write_time    = 0
+        self.wall_time     = 0
+        self.tick_drift    = 0
+        self.skipped_ticks = 0
+
+    def add_request(self, latency, n_bytes):
+        '''
+        Adds a request answered by the API
+
+        Parameters
+        ----------
+        latency : float
+            Seconds since the request was sent until the body was received
+        n_bytes : int
+            Size of the body of the response
+        '''
+        self.latencies.append(latency)
+        self.bytes += n_bytes
+
+    def merge(self, other):
+        '''
+        Adds the requests of a shard of the burst, performed by another process
+        '''
+        self.latencies     += other.latencies
+        self.request_times += other.request_times
+        self.bytes         += other.bytes
+        self.ok            += other.ok
+        self.not_ok        += other.not_ok
+        self.parse_time    += other.parse_time
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self.start
+
+    def to_dict(self):
+        #Cumulative histogram of the latencies
+        histogram,latencies = {},sorted(self.latencies)
+        n = 0
+        for bound in LATENCY_BUCKETS :
+            while n < len(latencies) and latencies[n] <= bound :
+                n += 1
+            histogram['le_' + str(bound)] = n
+
+        def percentile(values,q) :
+            return round(values[min(int(q*len(values)),len(values)-1)],4) if len(values) > 0 else None
+
+        request_times = sorted(self.request_times)
+        return {
+            'burst': self.burst,
+            'datetime': str(self.datetime),
+            'requests_ok': self.ok,
+            'requests_not_ok': self.not_ok,
+            'latency_histogram': histogram,
+            'latency_p50': percentile(latencies,0.5),
+            'latency_p95': percentile(latencies,0.95),
+            'latency_max': percentile(latencies,1),
+            'request_time_p50': percentile(request_times,0.5),
+            'request_time_max': percentile(request_times,1),
+            'bytes_received': self.bytes,
+            'rows': self.rows,
+            'raw_rows': self.raw_rows,
+            'parse_time': round(self.parse_time,4),
+            'write_time': round(self.write_time,4),
+            'wall_time': round(self.wall_time,4),
+            'tick_drift': round(self.tick_drift,4),
+            'skipped_ticks': self.skipped_ticks
+        }
+
+
+class MetricsRegistry(object):
+    '''
+    Keeps the metrics of the last bursts, writes them to a rolling file and
+    serves them as json in a local endpoint
+    '''
+    def __init__(self, f, n_bursts=100, max_bytes=10*1024*1024, backup_count=3):
+        '''
+        Parameters
+        ----------
+        f : str
+            File where a json line is written for every burst
+        n_bursts : int
+            Number of bursts served by the endpoint
+        max_bytes, backup_count : int
+            Size of the file before rolling it and number of old files kept
+        '''
+        self.bursts = deque(maxlen=n_bursts)
+        self.lock   = Lock()
+        self.logger = logging.getLogger('collector_metrics')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(RotatingFileHandler(f, maxBytes=max_bytes, backupCount=backup_count))
+
+    def record(self, metrics):
+        '''
+        Stores the metrics of a finished burst
+        '''
+        metrics_dict = metrics.to_dict()
+        with self.lock :
+            self.bursts.append(metrics_dict)
+        self.logger.info(json.dumps(metrics_dict))
+
+    async def handle_metrics(self, request):
+        with self.lock :
+            bursts = list(self.bursts)
+        return web.json_response({
+            'last': bursts[-1] if len(bursts) > 0 else None,
+            'bursts': bursts
+        })
+
+    async def start_server(self, port):
+        '''
+        Starts the endpoint http://127.0.0.1:port/metrics in the running loop
+        '''
+        app = web.Application()
+        app.add_routes([web.get('/metrics', self.handle_metrics)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
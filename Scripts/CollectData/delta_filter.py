@@ -0,0 +1,63 @@
+from threading import Lock
+
+#Keys of an observation inside a burst
+BURST_KEY = ['bus','stop','line','destination']
+
+class DeltaFilter(object):
+    '''
+    Leaves only the observations of a bus at a stop that changed since the
+    last time they were written. The same estimation is often returned
+    unchanged across consecutive bursts, so writing just the changes
+    shrinks the raw data without losing information. Unchanged observations
+    are written again every max_age seconds, so the gaps between rows of a
+    bus stay shorter than the ones used to split its trips.
+    '''
+    def __init__(self, max_age=300):
+        '''
+        Parameters
+        ----------
+        max_age : int
+            Seconds after which an unchanged observation is written again
+        '''
+        self.max_age = max_age
+        self.last    = {}
+        self.lock    = Lock()
+
+    def filter(self, buses_df):
+        '''
+        Returns the rows of the burst whose estimateArrive or DistanceBus changed
+
+        Parameters
+        ----------
+        buses_df : DataFrame
+            Burst of data without duplicates
+        '''
+        mask = []
+        with self.lock :
+            for bus,stop,date_time,eta,dist in zip(buses_df.bus,buses_df.stop,buses_df.datetime,
+                                                   buses_df.estimateArrive,buses_df.DistanceBus) :
+                last = self.last.get((bus,stop))
+                changed = (last == None) or (last[0] != eta) or (last[1] != dist) or \
+                          ((date_time - last[2]).total_seconds() >= self.max_age)
+                if changed :
+                    self.last[(bus,stop)] = (eta,dist,date_time)
+                mask.append(changed)
+
+            #Forget the observations that are going to be written again anyway
+            if len(buses_df) > 0 :
+                now = max(buses_df.datetime)
+                self.last = {key : last for key,last in self.last.items() \
+                             if (now - last[2]).total_seconds() < self.max_age}
+        return buses_df.loc[mask].reset_index(drop=True)
+
+
+def drop_duplicates(buses_df) :
+    '''
+    Returns the burst with a single row for every bus, stop, line and destination
+
+    Parameters
+    ----------
+    buses_df : DataFrame
+        Burst of data
+    '''
+    return buses_df.drop_duplicates(BURST_KEY).reset_index(drop=True)
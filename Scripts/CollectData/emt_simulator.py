@@ -0,0 +1,190 @@
+#Local stand in of the EMT Madrid API to test and benchmark the collector.
+#
+#Serves the login and arrives endpoints used by retrieve_data.py, with
+#synthetic arrivals for the stops in line_stops_dict.json or replaying the
+#rows of a recorded burst file. Run it from the repository root and point
+#the collector to it:
+#
+#   python3 Scripts/CollectData/emt_simulator.py --port 8080 --latency 80 --error-rate 0.01 --hits 20000
+#   EMT_API_URL=http://127.0.0.1:8080 python3 Scripts/CollectData/retrieve_data.py
+
+import pandas as pd
+import json
+
+import os.path
+import random
+import uuid
+import argparse
+
+import datetime
+
+import asyncio
+from aiohttp import web
+
+# WE LOAD THE STOPS AND LINES
+with open('Data/Static/line_stops_dict.json', 'r') as f:
+    line_stops_dict = json.load(f)
+with open('Data/Static/lines_collected_dict.json', 'r') as f:
+    lines_collected_dict = json.load(f)
+#Line short names used by the API, the line ids when lines_shapes is not available
+if os.path.isfile('Data/Static/lines_shapes.csv') :
+    lines_shapes = pd.read_csv('Data/Static/lines_shapes.csv')
+    line_sns_dict = lines_shapes.drop_duplicates('line_id').set_index('line_id').line_sn.to_dict()
+else :
+    line_sns_dict = {}
+
+#Lines and destinations passing through every stop
+stop_lines_dict = {}
+for line_id,line_stops in line_stops_dict.items() :
+    if line_stops == None :
+        continue
+    line_sn = str(line_sns_dict.get(int(line_id),line_id)) if line_id.isdigit() else line_id
+    for direction in ['1','2'] :
+        if line_stops.get(direction) == None :
+            continue
+        if line_sn in lines_collected_dict :
+            #The destination of direction 1 is the second one of the list
+            destination = lines_collected_dict[line_sn]['destinations'][1 if direction == '1' else 0]
+        else :
+            destination = 'DESTINATION {}'.format(direction)
+        for stop in line_stops[direction] :
+            stop_lines_dict.setdefault(str(stop),[]).append((line_sn,destination))
+
+
+class Simulator(object):
+    '''
+    State of the simulated API: accounts, tokens and hits spent
+    '''
+    def __init__(self, latency, error_rate, hits, replay_df):
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.hits       = hits
+        self.replay_df  = replay_df
+        self.tokens     = {}
+        self.spent      = {}
+        self.n_requests = 0
+
+    async def delay(self):
+        #Exponentially distributed latency around the mean
+        if self.latency > 0 :
+            await asyncio.sleep(random.expovariate(1000/self.latency))
+
+    async def login(self, request):
+        await self.delay()
+        account = request.headers.get('email',request.headers.get('X-ClientId','anonymous'))
+        spent = self.spent.setdefault(account,0)
+        if spent >= self.hits :
+            return web.json_response({'code':'98','description':'No hits available','datetime':now_str(),'data':[]})
+        token = str(uuid.uuid4())
+        self.tokens[token] = account
+        return web.json_response({
+            'code': '01',
+            'description': 'Token extended (lapsed: 1 millsecs)',
+            'datetime': now_str(),
+            'data': [{
+                'accessToken': token,
+                'tokenSecExpiration': 86400,
+                'email': account,
+                'apiCounter': {'current': spent, 'dailyUse': self.hits}
+            }]
+        })
+
+    async def arrives(self, request):
+        self.n_requests += 1
+        await self.delay()
+        account = self.tokens.get(request.headers.get('accessToken'))
+        if account == None :
+            return web.json_response({'code':'80','description':'Invalid token','datetime':now_str(),'data':[]})
+        if random.random() < self.error_rate :
+            raise web.HTTPInternalServerError()
+        if self.spent[account] >= self.hits :
+            return web.json_response({'code':'98','description':'No hits available','datetime':now_str(),'data':[]})
+        self.spent[account] += 1
+
+        stop = request.match_info['stop']
+        if self.replay_df is not None :
+            buses = replay_buses(self.replay_df,stop)
+        else :
+            buses = synthetic_buses(stop)
+        return web.json_response({
+            'code': '00',
+            'description': 'Data recovered OK (lapsed: {} millsecs)'.format(random.randint(5,60)),
+            'datetime': now_str(),
+            'data': [{'Arrive': buses, 'StopInfo': [], 'ExtraInfo': [], 'Incident': {}}]
+        })
+
+    async def stats(self, request):
+        return web.json_response({'requests': self.n_requests, 'hits_spent': self.spent})
+
+
+def now_str() :
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def bus_dict(line,stop,destination,bus,eta,distance,lon,lat) :
+    '''
+    Returns a bus arrival with the fields of the API
+    '''
+    return {
+        'line': line,
+        'stop': str(stop),
+        'isHead': 'False',
+        'destination': destination,
+        'deviation': 0,
+        'bus': int(bus),
+        'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+        'estimateArrive': int(eta),
+        'DistanceBus': int(distance),
+        'positionTypeBus': '0'
+    }
+
+
+def synthetic_buses(stop) :
+    '''
+    Returns up to two random arrivals of every line and direction passing through the stop
+    '''
+    buses = []
+    for line,destination in stop_lines_dict.get(str(stop),[]) :
+        for i in range(random.randint(0,2)) :
+            eta = random.randint(10,1800)
+            buses.append(bus_dict(line,stop,destination,random.randint(1000,9999),eta,6*eta,-3.7,40.4))
+    return buses
+
+
+def replay_buses(replay_df,stop) :
+    '''
+    Returns the arrivals of the stop in the recorded burst
+    '''
+    stop_df = replay_df.loc[replay_df.stop == int(stop)]
+    return [
+        bus_dict(row.line,row.stop,row.destination,row.bus,row.estimateArrive,row.DistanceBus,
+                 getattr(row,'lon',0),getattr(row,'lat',0))
+        for row in stop_df.itertuples()
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local simulator of the EMT Madrid API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=50, help='Mean latency of the responses in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of arrives requests answered with a 500 error')
+    parser.add_argument('--hits', type=int, default=20000, help='Daily hits of every account')
+    parser.add_argument('--replay', default=None, help='Burst csv file to replay instead of synthetic arrivals')
+    args = parser.parse_args()
+
+    replay_df = None
+    if args.replay != None :
+        replay_df = pd.read_csv(args.replay, dtype={'line': 'str', 'destination': 'str'})
+
+    simulator = Simulator(args.latency,args.error_rate,args.hits,replay_df)
+    app = web.Application()
+    app.add_routes([
+        web.get('/v2/mobilitylabs/user/login/', simulator.login),
+        web.post('/v2/transport/busemtmad/stops/{stop}/arrives/{line:.*}', simulator.arrives),
+        web.get('/stats', simulator.stats)
+    ])
+    print('\n----- EMT API simulator listening on port {} - {} stops -----\n'.format(args.port,len(stop_lines_dict)))
+    web.run_app(app, port=args.port, print=None)
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,149 @@
+import heapq
+import datetime
+from threading import Lock
+
+#Daily hits of an account when the login does not inform about them
+DAILY_HITS = 20000
+
+class HitsBudget(object):
+    '''
+    Keeps the hits remaining in each of the EMT accounts, spreads the requests
+    of every burst among them and picks the polling interval that makes the
+    hits last until they are renewed at midnight.
+    '''
+    def __init__(self, n_accounts, login, min_interval=30, max_interval=600):
+        '''
+        Parameters
+        ----------
+        n_accounts : int
+            Number of accounts available
+        login : function
+            Function that receives the account index and returns the json
+            response of the login or 'Error'
+        min_interval, max_interval : int
+            Limits in seconds of the polling interval
+        '''
+        self.n_accounts   = n_accounts
+        self.login        = login
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tokens       = [None]*n_accounts
+        self.remaining    = [0]*n_accounts
+        self.day          = None
+        self.lock         = Lock()
+
+    def refresh(self):
+        '''
+        Logs in every account and reads the hits it has left for today
+        '''
+        for account in range(self.n_accounts) :
+            #Try until we get response to the login without errors
+            json_response = 'Error'
+            while json_response == 'Error' :
+                json_response = self.login(account)
+
+            with self.lock :
+                if (json_response['code'] == '00') | (json_response['code'] == '01') :
+                    data = json_response['data'][0]
+                    self.tokens[account] = data['accessToken']
+                    try :
+                        api_counter = data['apiCounter']
+                        self.remaining[account] = max(int(api_counter['dailyUse']) - int(api_counter['current']),0)
+                    except :
+                        self.remaining[account] = DAILY_HITS
+                else :
+                    self.tokens[account] = None
+                    self.remaining[account] = 0
+            print('Account {} has {} hits available\n'.format(account,self.remaining[account]))
+
+        self.day = datetime.date.today()
+
+    def needs_refresh(self):
+        '''
+        Returns true if the hits have been renewed since the last refresh
+        '''
+        return self.day != datetime.date.today()
+
+    def total_remaining(self):
+        '''
+        Returns the hits left among all the accounts
+        '''
+        with self.lock :
+            return sum(self.remaining)
+
+    def assign(self, stops):
+        '''
+        Returns a list of (stop, account, accessToken) spreading the stops among
+        the accounts with more hits left and consuming one hit for each of them.
+        Stops that do not fit in the budget are left out.
+
+        Parameters
+        ----------
+        stops : list
+            Stops to request in the burst
+        '''
+        with self.lock :
+            heap = [(-hits,account) for account,hits in enumerate(self.remaining) if hits > 0]
+            heapq.heapify(heap)
+            assignments = []
+            for stop in stops :
+                if len(heap) == 0 :
+                    break
+                hits,account = heapq.heappop(heap)
+                assignments.append((stop,account,self.tokens[account]))
+                self.remaining[account] -= 1
+                if hits + 1 < 0 :
+                    heapq.heappush(heap,(hits+1,account))
+            return assignments
+
+    def retry_hits(self, accounts):
+        '''
+        Returns a dict with the hits left in each of the accounts, which the
+        requests of a burst can spend retrying
+
+        Parameters
+        ----------
+        accounts : iterable
+            Accounts of the burst
+        '''
+        with self.lock :
+            return {account : self.remaining[account] for account in set(accounts)}
+
+    def spend(self, account, hits):
+        '''
+        Consumes hits of the account spent out of assign, like the retries of the requests
+
+        Parameters
+        ----------
+        account : int
+            Account index
+        hits : int
+            Hits spent
+        '''
+        with self.lock :
+            self.remaining[account] = max(self.remaining[account] - hits,0)
+
+    def exhausted(self, account):
+        '''
+        Marks the account as out of hits until the next refresh
+        '''
+        with self.lock :
+            self.remaining[account] = 0
+
+    def interval(self, n_requests, seconds_left):
+        '''
+        Returns the polling interval in seconds that spends the hits left
+        evenly over the remaining collection time, or None if there are no hits
+
+        Parameters
+        ----------
+        n_requests : int
+            Requests performed in every burst
+        seconds_left : float
+            Seconds of collection left until the hits are renewed
+        '''
+        total = self.total_remaining()
+        if total <= 0 :
+            return None
+        bursts_left = total / max(n_requests,1)
+        return min(max(seconds_left / bursts_left, self.min_interval), self.max_interval)
@@ -0,0 +1,119 @@
+import os
+import time
+import datetime
+from threading import Thread, Lock
+from queue import Queue, Empty
+
+import pandas as pd
+
+class RawSpool(object):
+    '''
+    Write-ahead spool of the raw data. The collector hands every burst to
+    put, which saves it in a spool file and queues it, and a background
+    thread appends the queued bursts in batches to the raw data files,
+    deleting their spool files once they are written. A batch that fails is
+    written again, waiting longer after every failure, before the next one,
+    so the bursts are always appended in order. The spool files left by a
+    crash are written again, in order, when the spool is started, so a burst
+    can be appended twice but it is never lost.
+    '''
+    def __init__(self, write, directory, max_queue=64, batch_size=16, max_retry_delay=60):
+        '''
+        Parameters
+        ----------
+        write : function
+            Function that appends a dataframe with a batch of bursts to the raw data.
+            It has to append all of them or none, raising an exception
+        directory : str
+            Directory of the spool files
+        max_queue : int
+            Bursts waiting to be written before put blocks the collector
+        batch_size : int
+            Maximum number of bursts appended at once
+        max_retry_delay : int
+            Maximum seconds waited before writing a failed batch again
+        '''
+        self.write      = write
+        self.directory  = directory
+        self.queue      = Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.max_retry_delay = max_retry_delay
+        self.thread     = None
+        self.n_spooled  = 0
+        self.lock       = Lock()
+
+    def start(self):
+        '''
+        Writes the bursts left in the spool and starts the writer thread
+        '''
+        with self.lock :
+            if self.thread is not None :
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            #Bursts being saved when the collector died, they were never queued
+            for f in os.listdir(self.directory) :
+                if f.endswith('.pkl.tmp') :
+                    os.remove(os.path.join(self.directory,f))
+            #Files are named after the time they were spooled, so sorting them gives their order
+            spooled = sorted([f for f in os.listdir(self.directory) if f.endswith('.pkl')])
+            if len(spooled) > 0 :
+                print('Recovering {} bursts from the spool - {}\n'.format(len(spooled),datetime.datetime.now()))
+                for i in range(0,len(spooled),self.batch_size) :
+                    paths = [os.path.join(self.directory,f) for f in spooled[i:i+self.batch_size]]
+                    self._flush([(path,pd.read_pickle(path)) for path in paths])
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def put(self, df):
+        '''
+        Saves the burst in the spool and queues it to be written
+
+        Parameters
+        ----------
+        df : DataFrame
+            Burst of raw data
+        '''
+        self.start()
+        self.n_spooled += 1
+        path = os.path.join(self.directory,'{}-{:06d}.pkl'.format(
+            datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'),self.n_spooled % 1000000))
+        #Renamed once complete, a crash never leaves half a burst in the spool
+        df.to_pickle(path+'.tmp')
+        os.replace(path+'.tmp',path)
+        self.queue.put((path,df))
+
+    def join(self):
+        '''
+        Waits until every queued burst has been written
+        '''
+        self.queue.join()
+
+    def _run(self):
+        while True :
+            #Wait for a burst and take the ones queued behind it
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size :
+                try :
+                    batch.append(self.queue.get_nowait())
+                except Empty :
+                    break
+            self._flush(batch)
+            for item in batch :
+                self.queue.task_done()
+
+    def _flush(self, batch):
+        df = pd.concat([df for path,df in batch])
+        delay = 1
+        while True :
+            try :
+                self.write(df)
+                break
+            except Exception as e :
+                #The next batches wait, the spool files are kept in case the collector is stopped
+                print('Error writing {} bursts of raw data, trying again in {} seconds - {}'.format(len(batch),delay,datetime.datetime.now()))
+                print(e)
+                print('\n')
+                time.sleep(delay)
+                delay = min(2*delay,self.max_retry_delay)
+        for path,df in batch :
+            os.remove(path)
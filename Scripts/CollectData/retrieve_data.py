@@ -3,60 +3,61 @@ import json
 
 import re
 import os.path
+import sys
 import random
 
 import time
 import datetime
+import multiprocessing
+from collections import deque
 from datetime import timedelta
-from threading import Timer
+from threading import Thread, Lock
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+
+#EMT API, can be pointed to the local simulator emt_simulator.py
+API_URL = os.environ.get('EMT_API_URL','https://openapi.emtmadrid.es')
+
+#Async collector parameters
+MAX_CONCURRENT_REQUESTS = 50 #Requests in flight at the same time
+REQUEST_TIMEOUT = 5 #Seconds
+REQUEST_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = (500, 502, 504)
+OUTPUT_FORMAT = 'csv' #'csv', or 'arrow' for typed Arrow files partitioned by day
+ADAPTIVE_POLLING = True #Poll less often the stops without buses about to arrive, the bursts published keep the last rows of the others
+HITS_WINDOW = 10 #Last bursts whose hits give the polling interval
+POOL_SIZE = 100 #Keep-alive connections kept open against the API
+KEEPALIVE_TIMEOUT = 120 #Seconds, longer than the interval between bursts
+METRICS_PORT = 9100 #Local endpoint with the metrics of the last bursts, http://127.0.0.1:9100/metrics
+METRICS_FILE = 'Data/RealTime/collector_metrics.jsonl' #Rolling file with the metrics of every burst
+RAW_SPOOL_DIR = 'Data/Raw/spool/' #Bursts not yet appended to the raw data
+RAW_QUEUE_SIZE = 64 #Bursts waiting to be written before the collector waits for the disk
+RAW_BATCH_SIZE = 16 #Bursts appended at once by the writer thread
+RAW_FSYNC = True #Wait until every batch of raw data is on disk
+RAW_DELTAS = True #Append only the observations that changed, False to append full snapshots
+DELTA_MAX_AGE = 300 #Seconds after which an unchanged observation is appended again
+N_SHARDS = 1 #Worker processes performing the requests, each one with the accounts of index % N_SHARDS
+DAY_LINES = [1,44,82,132,133] #Line ids collected during the day, or 'all'
+NIGHT_LINES = [502,506] #Night line ids collected in the weekend nights, or 'all'
 
 # WE LOAD THE STOPS AND LINES
 lines_shapes = pd.read_csv('Data/Static/lines_shapes.csv')
+#Line short name to line id map, built once instead of scanning lines_shapes for every bus
+line_ids_dict = lines_shapes.drop_duplicates('line_sn').set_index('line_sn').line_id.to_dict()
+line_sns_dict = {line_id : line_sn for line_sn,line_id in line_ids_dict.items()}
 with open('Data/Static/line_stops_dict.json', 'r') as f:
     line_stops_dict = json.load(f)
-
-class RepeatedTimer(object):
-    def __init__(self, interval, function, *args, **kwargs):
-        self._timer     = None
-        self.interval   = interval
-        self.function   = function
-        self.args       = args
-        self.kwargs     = kwargs
-        self.is_running = False
-        self.start()
-
-    def _run(self):
-        self.is_running = False
-        self.start()
-        self.function(*self.args, **self.kwargs)
-
-    def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
-
-    def stop(self):
-        self._timer.cancel()
-        self.is_running = False
-
-#Check if time is inside range
-def time_in_range(start, end, x):
-    """Return true if x is in the range [start, end]"""
-    if start <= end:
-        return start <= x <= end
-    else:
-        return start <= x or x <= end
+with open('Data/Static/freq_ranges_dict.json', 'r') as f:
+    freq_ranges_dict = json.load(f)
 
 # API FUNCTIONS
-def requests_retry_session(retries=3,backoff_factor=0.3,status_forcelist=(500, 502, 504),session=None):
+def requests_retry_session(retries=3,backoff_factor=0.3,status_forcelist=(500, 502, 504),session=None,pool_size=10):
     '''
     Function to ensure we get a good response for the request
     '''
@@ -68,12 +69,42 @@ def requests_retry_session(retries=3,backoff_factor=0.3,status_forcelist=(500, 5
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry,pool_connections=pool_size,pool_maxsize=pool_size)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
-def get_access_token(email,password) :
+#Sessions and event loop shared by all the requests and bursts, so the connections are reused
+api_session = requests_retry_session(pool_size=POOL_SIZE)
+arrivals_session = None
+collector_loop = None
+collector_loop_lock = Lock()
+
+def get_collector_loop() :
+    '''
+    Returns the event loop where the bursts are performed, starting it
+    in a background thread the first time it is called
+    '''
+    global collector_loop
+    with collector_loop_lock :
+        if collector_loop is None :
+            collector_loop = asyncio.new_event_loop()
+            Thread(target=collector_loop.run_forever,daemon=True).start()
+    return collector_loop
+
+def get_arrivals_session() :
+    '''
+    Returns the keep-alive session used for the arrivals requests. Must be
+    called from inside the collector loop
+    '''
+    global arrivals_session
+    if (arrivals_session is None) or arrivals_session.closed :
+        arrivals_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=POOL_SIZE,keepalive_timeout=KEEPALIVE_TIMEOUT)
+        )
+    return arrivals_session
+
+def get_access_token(email,password,client_api=False) :
     '''
     Returns the access token of the EMT Madrid API
 
@@ -83,12 +114,14 @@ def get_access_token(email,password) :
             The email of the account
         password : string
             Password of the account
+        client_api : bool
+            Whether to log in with the XClientId and passKey of the API account
     '''
     try:
-        if account_index == 0 :
+        if client_api :
             #Special request for the account with API
-            response = requests_retry_session().get(
-                'https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/',
+            response = api_session.get(
+                API_URL + '/v2/mobilitylabs/user/login/',
                 headers={
                     'X-ClientId':XClientId,
                     'passKey':passKey
@@ -96,8 +129,8 @@ def get_access_token(email,password) :
                 timeout=5
             )
         else :
-            response = requests_retry_session().get(
-                'https://openapi.emtmadrid.es/v2/mobilitylabs/user/login/',
+            response = api_session.get(
+                API_URL + '/v2/mobilitylabs/user/login/',
                 headers={
                     'email':email,
                     'password':password
@@ -112,16 +145,25 @@ def get_access_token(email,password) :
         print('\n')
         return 'Error'
 
-def get_arrival_times(stopId,accessToken) :
+async def get_arrival_times(session,semaphore,stopId,accessToken,metrics=None,spend_retry=None) :
     """
     Returns the arrival data of buses for the desired stop and line
 
         Parameters
         ----------
+        session : aiohttp.ClientSession
+            The session used to perform the request
+        semaphore : asyncio.Semaphore
+            Semaphore that bounds the number of concurrent requests
         stopId : string
             The stop code
         accessToken: string
             The accessToken obtained in the login
+        metrics : BurstMetrics
+            Metrics of the burst where the latency and size of the response are added
+        spend_retry : function
+            Function that consumes a hit of the account for a retry and returns false
+            if there are none left, None to retry without limit
     """
 
     #We build the body for the request
@@ -133,292 +175,612 @@ def get_arrival_times(stopId,accessToken) :
         'DateTime_Referenced_Incidencies_YYYYMMDD':'20200130'
     }
 
-    #And we perform the request
-    try:
-        response = requests_retry_session().post(
-            'https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/{}/arrives/{}/'.format(stopId,''),
-            data = json.dumps(body),
-            headers = {
-                'accessToken': accessToken,
-                'Content-Type': 'application/json'
-            },
-            timeout = 5
-        )
-        #Return the response if we received it ok
-        return response
-    except Exception as e:
-        print('There was an error in the request \n')
-        print(e)
-        print('\n')
-        return 'Error'
+    #And we perform the request, retrying with backoff like requests_retry_session does
+    for retry in range(REQUEST_RETRIES+1) :
+        try:
+            async with semaphore :
+                start = time.perf_counter()
+                async with session.post(
+                    API_URL + '/v2/transport/busemtmad/stops/{}/arrives/{}/'.format(stopId,''),
+                    data = json.dumps(body),
+                    headers = {
+                        'accessToken': accessToken,
+                        'Content-Type': 'application/json'
+                    },
+                    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+                ) as response :
+                    if response.status in RETRY_STATUS_FORCELIST :
+                        raise aiohttp.ClientResponseError(response.request_info,response.history,status=response.status)
+                    elif response.status != 200 :
+                        return 'Error'
+                    #Return the response data if we received it ok
+                    content = await response.read()
+                    if metrics is not None :
+                        metrics.add_request(time.perf_counter()-start,len(content))
+                    return json.loads(content)
+        except asyncio.CancelledError :
+            raise
+        except Exception as e:
+            #Every attempt may spend a hit, do not retry without hits left
+            if (retry == REQUEST_RETRIES) or ((spend_retry is not None) and (not spend_retry())) :
+                print('There was an error in the request \n')
+                print(e)
+                print('\n')
+                return 'Error'
+            await asyncio.sleep(RETRY_BACKOFF_FACTOR*(2**retry))
+
+#The keys for the dataframe that is going to be built
+burst_keys = ['bus','line','stop','datetime','isHead','destination','deviation','estimateArrive','DistanceBus','request_time','given_coords','lat','lon']
+
+def get_lapsed_time(arrival_data) :
+    """
+    Returns the milliseconds the API took to answer, from the description of the response
+    """
+    try :
+        return int(re.search('lapsed: (.*) millsecs', arrival_data['description']).group(1))
+    except :
+        return 0
 
-def get_arrival_data(requested_lines) :
+def parse_arrival_data(arrival_data,requested_lines,columns) :
     """
-    Returns the data of all the buses inside the requested lines
+    Flattens the buses of an arrivals response into the column buffers
+    and returns the number of rows added
 
         Parameters
         ----------
+        arrival_data : dict
+            The json response of the arrivals request
         requested_lines : list
             List with the desired line ids
+        columns : dict
+            Lists where the values of every key in burst_keys are appended
     """
+    lapsed_time = get_lapsed_time(arrival_data)
+    date_time = datetime.datetime.strptime(arrival_data['datetime'], '%Y-%m-%dT%H:%M:%S.%f')
+
+    #We get the buses data
+    n_rows = 0
+    buses_data = arrival_data['data'][0]['Arrive']
+    for bus in buses_data :
+        #Get the line id of the bus
+        if line_ids_dict.get(bus['line']) in requested_lines :
+            #Given coordinates provided by the API
+            lon,lat = bus['geometry']['coordinates'][0:2]
+            bus['datetime'] = date_time
+            bus['request_time'] = lapsed_time
+            bus['given_coords'] = 1 if (lat!=0) and (lon!=0) else 0
+            bus['lat'] = lat
+            bus['lon'] = lon
+            for key in burst_keys :
+                columns[key].append(bus[key])
+            n_rows += 1
+    return n_rows
+
+def get_stops_of_lines(requested_lines) :
+    """
+    Returns the list of different stops of the requested lines
 
-    #We get the list of stops to ask for
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+    """
     stops_of_lines = []
     for line_id in requested_lines :
         line_id = str(line_id)
-        if line_stops_dict[line_id] != None :
-            if line_stops_dict[line_id]['1'] != None :
+        if line_stops_dict.get(line_id) != None :
+            #Some lines have no stops in any direction
+            if line_stops_dict[line_id].get('1') != None :
                 stops_of_lines = stops_of_lines + line_stops_dict[line_id]['1']
-            if line_stops_dict[line_id]['2'] != None :
+            if line_stops_dict[line_id].get('2') != None :
                 stops_of_lines = stops_of_lines + line_stops_dict[line_id]['2']
 
     #List of different stops
-    stops_of_lines = list(set(stops_of_lines))
-
-    #The keys for the dataframe that is going to be built
-    keys = ['bus','line','stop','datetime','isHead','destination','deviation','estimateArrive','DistanceBus','request_time','given_coords','lat','lon']
-
-    #Function to perform the requests asynchronously, performing them concurrently would be too slow
-    async def get_data_asynchronous() :
-        global account_index
-        global accessToken
-        global out_of_hits
-        global day_burst
-
-        #We increase the day burst by one
-        day_burst = day_burst + 1
-
-        row_list = []
-
-        #Información de la recogida de datos
-        n_ok_answers = 0
-        n_not_ok_answers = 0
-
-        #We set the number of workers that is going to take care about the requests
-        with ThreadPoolExecutor(max_workers=50) as executor:
-            #We create a loop object
-            loop = asyncio.get_event_loop()
-            #And a list of tasks to be performed by the loop
-            tasks = [
-                loop.run_in_executor(
-                    executor,
-                    get_arrival_times, #Function that is gonna be called by the tasks
-                    *(stopId,accessToken)  #Parameters for the function
-                )
-                for stopId in stops_of_lines
-            ]
-            #We randomize the order of the tasks
-            random.shuffle(tasks)
-            #And finally we perform the tasks and gather the information returned by them into two lists
-            for response in await asyncio.gather(*tasks) :
-                if not response == 'Error' :
-                    if response.status_code == 200 :
-                        arrival_data = response.json()
-                        n_ok_answers = n_ok_answers + 1
-                        if arrival_data['code'] == '98':
-                            #If we spend all the hits we switch the account and wait for next request
-                            out_of_hits = True
-                            print('Hits of account_index = {} spent - {}\n'.format(account_index,datetime.datetime.now()))
-                            #Return the data gathered if the request that fails isnt the first
-                            if len(row_list) == 0 :
-                                return None
-                            else :
-                                print('Appending data gathered before end of hits\n')
-                                return row_list, n_ok_answers, n_not_ok_answers
-                    else :
-                        #If the response isnt okey we pass to the next iteration
-                        n_not_ok_answers = n_not_ok_answers + 1
-                        continue
-                else :
-                    #If the response isnt okey we pass to the next iteration
-                    n_not_ok_answers = n_not_ok_answers + 1
-                    continue
-                try :
-                    lapsed_time = int(re.search('lapsed: (.*) millsecs', arrival_data['description']).group(1))
-                except : 
-                    lapsed_time = 0
-                date_time = datetime.datetime.strptime(arrival_data['datetime'], '%Y-%m-%dT%H:%M:%S.%f')
-
-                #We get the buses data
-                buses_data = arrival_data['data'][0]['Arrive']
-                for bus in buses_data :
-                    #Get the line rows for each direction
-                    line_id = lines_shapes.loc[lines_shapes.line_sn==bus['line']].iloc[0].line_id
-                    if line_id in requested_lines :
-                        #Given coordinates provided by the API
-                        bus['lon'] = bus['geometry']['coordinates'][0]
-                        bus['lat'] = bus['geometry']['coordinates'][1]
-                        if (bus['lat']!=0) and (bus['lon']!=0) :
-                            bus['given_coords'] = 1
-                        else :
-                            bus['given_coords'] = 0
-
-                        bus['datetime'] = date_time
-                        bus['request_time'] = lapsed_time
-                        values = [bus[key] for key in keys]
-                        row_list.append(dict(zip(keys, values)))
-
-
-        return row_list,n_ok_answers,n_not_ok_answers
-
-    #We declare the loop and call it, then we run it until it is complete
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    future = asyncio.ensure_future(get_data_asynchronous())
-    loop.run_until_complete(future)
-
-    #And once it is completed we gather the information returned by it like this
-    future_result = future.result()
-    if future_result == None :
-        return None
+    return list(set(stops_of_lines))
+
+def get_requested_lines(lines,night=False) :
+    """
+    Returns the list of line ids to collect
+
+        Parameters
+        ----------
+        lines : list or str
+            List with the desired line ids, or 'all' for every line in line_stops_dict
+        night : bool
+            Whether the lines are night lines, ids 501 to 599
+    """
+    if lines == 'all' :
+        return sorted([int(line_id) for line_id in line_stops_dict.keys() \
+                       if line_id.isdigit() and ((500 < int(line_id) < 600) == night)])
+    return lines
+
+#Schedulers of the stops polled by each set of requested lines
+stops_schedulers = {}
+
+def get_stops_scheduler(requested_lines) :
+    """
+    Returns the scheduler that decides which stops of the requested lines are polled
+
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+    """
+    key = tuple(requested_lines)
+    if key not in stops_schedulers :
+        stops_schedulers[key] = StopsScheduler(requested_lines,line_stops_dict,freq_ranges_dict,line_sns_dict)
+    return stops_schedulers[key]
+
+#Writer of the raw data when the output format is arrow
+raw_writer = None
+
+def get_raw_writer() :
+    """
+    Returns the writer of the day partitioned raw data
+    """
+    global raw_writer
+    if raw_writer is None :
+        raw_writer = DayPartitionedWriter('Data/Raw/buses_data/')
+    return raw_writer
+
+def write_raw_data(buses_df) :
+    """
+    Appends one or more bursts to the raw data files. Called from the
+    writer thread of the raw spool only, so appends never interleave.
+    A failed append is cut off the file, so it can be written again
+
+        Parameters
+        ----------
+        buses_df : DataFrame
+            The bursts of data
+    """
+    if OUTPUT_FORMAT == 'arrow' :
+        get_raw_writer().write(buses_df,fsync=RAW_FSYNC)
     else :
-        row_list = future_result[0]
-        n_ok_answers = future_result[1]
-        n_not_ok_answers = future_result[2]
-
-        #We create the dataframe of the buses
-        buses_df = pd.DataFrame(row_list, columns=keys)
-
-        #And we append the data to the csv
-        f='Data/Raw/buses_data.csv'
-        f_burst='Data/RealTime/buses_data_burst.csv'
-        if os.path.isfile(f) :
-            buses_df.to_csv(f, mode='a', header=False)
+        f = 'Data/Raw/buses_data.csv'
+        size = os.path.getsize(f) if os.path.isfile(f) else 0
+        try :
+            with open(f, 'a') as f_raw :
+                buses_df.to_csv(f_raw, header=(size == 0))
+                if RAW_FSYNC :
+                    f_raw.flush()
+                    os.fsync(f_raw.fileno())
+        except :
+            if os.path.isfile(f) :
+                os.truncate(f,size)
+            raise
+
+#Last burst published and lock to publish them one at a time
+burst_manifest_f = 'Data/RealTime/buses_data_burst.json'
+bursts_ring = None
+last_burst_id = None
+publish_lock = Lock()
+
+def publish_burst(buses_df) :
+    """
+    Writes the burst to the shared ring, and the burst file and its manifest
+    atomically, renaming temporary files. Returns the sequence number given
+    to the burst
+
+        Parameters
+        ----------
+        buses_df : DataFrame
+            The burst of data
+    """
+    global last_burst_id
+    global bursts_ring
+    with publish_lock :
+        #Continue the sequence of the last manifest written
+        if last_burst_id is None :
+            try :
+                with open(burst_manifest_f, 'r') as f:
+                    last_burst_id = json.load(f)['burst_id']
+            except :
+                last_burst_id = 0
+        burst_id = last_burst_id + 1
+
+        #Shared memory ring read by the detector
+        if bursts_ring is None :
+            bursts_ring = open_ring('bursts')
+        bursts_ring.write(burst_id,buses_df)
+
+        if OUTPUT_FORMAT == 'arrow' :
+            f_burst = 'Data/RealTime/buses_data_burst.feather'
+            write_burst(buses_df,f_burst+'.tmp')
         else :
-            buses_df.to_csv(f, mode='a', header=True)
-            
-        #Append to burst file
-        buses_df.to_csv(f_burst)
+            f_burst = 'Data/RealTime/buses_data_burst.csv'
+            buses_df.to_csv(f_burst+'.tmp')
+        os.replace(f_burst+'.tmp',f_burst)
+
+        manifest = {
+            'burst_id': burst_id,
+            'file': os.path.basename(f_burst),
+            'datetime': str(datetime.datetime.now()),
+            'rows': buses_df.shape[0]
+        }
+        with open(burst_manifest_f+'.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(burst_manifest_f+'.tmp',burst_manifest_f)
+
+        last_burst_id = burst_id
+    return burst_id
+
+async def collect_stops(assignments,requested_lines,metrics,retry_hits) :
+    """
+    Requests the arrivals of the assigned stops and flattens them into column
+    buffers. Returns the columns, the estimated arrival times of the buses of
+    every stop answered, the accounts that ran out of hits and the hits that
+    each account spent in retries
+
+        Parameters
+        ----------
+        assignments : list
+            List of (stop, account, token) tuples
+        requested_lines : list
+            List with the desired line ids
+        metrics : BurstMetrics
+            Metrics of the burst
+        retry_hits : dict
+            Hits left in every account of the assignments for the retries
+    """
+    requested_lines = set(requested_lines)
+
+    #Column buffers where the responses are flattened as they arrive
+    columns = {key : [] for key in burst_keys}
+    stop_etas = {}
+
+    #Información de la recogida de datos
+    n_ok_answers = 0
+    n_not_ok_answers = 0
+
+    #Semaphore to bound the number of requests in flight
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    session = get_arrivals_session()
+
+    #Hits spent in retries by every account
+    retries_spent = {account : 0 for account in retry_hits}
+    def spend_retry(account) :
+        if retries_spent[account] >= retry_hits[account] :
+            return False
+        retries_spent[account] += 1
+        return True
+
+    async def get_account_arrival_times(stopId,account,token) :
+        return stopId, account, await get_arrival_times(session,semaphore,stopId,token,metrics,lambda : spend_retry(account))
+
+    #List of tasks to be performed by the loop, and the ones of each account
+    tasks,account_tasks,spent_accounts = [],{},set()
+    for stopId,account,token in assignments :
+        task = asyncio.ensure_future(get_account_arrival_times(stopId,account,token))
+        tasks.append(task)
+        account_tasks.setdefault(account,[]).append(task)
+    #We randomize the order of the tasks
+    random.shuffle(tasks)
+    #And finally we parse every response as soon as it is completed
+    for next_response in asyncio.as_completed(tasks) :
+        try :
+            stopId,account,arrival_data = await next_response
+        except asyncio.CancelledError :
+            #Request of an account that ran out of hits
+            n_not_ok_answers = n_not_ok_answers + 1
+            continue
+        if arrival_data == 'Error' :
+            #If the response isnt okey we pass to the next iteration
+            n_not_ok_answers = n_not_ok_answers + 1
+            continue
+        if arrival_data['code'] == '98':
+            #If we spend all the hits of the account we stop using it
+            n_not_ok_answers = n_not_ok_answers + 1
+            if account not in spent_accounts :
+                spent_accounts.add(account)
+                print('Hits of account_index = {} spent - {}\n'.format(account,datetime.datetime.now()))
+                #Cancel the requests still pending for the account, they would also run out of hits
+                for task in account_tasks[account] :
+                    task.cancel()
+            continue
+        n_ok_answers = n_ok_answers + 1
+        start = time.perf_counter()
+        n_rows = parse_arrival_data(arrival_data,requested_lines,columns)
+        stop_etas[stopId] = columns['estimateArrive'][len(columns['estimateArrive'])-n_rows:]
+        metrics.parse_time += time.perf_counter() - start
+        metrics.request_times.append(get_lapsed_time(arrival_data))
+
+    metrics.ok,metrics.not_ok = n_ok_answers,n_not_ok_answers
+    return columns,stop_etas,spent_accounts,retries_spent
+
+#Pool of worker processes of the sharded mode and event loop of each worker
+shards_pool = None
+worker_loop = None
+
+def init_shard_worker() :
+    """
+    Starts the event loop of a worker process, where its bursts are performed
+    """
+    global worker_loop
+    global arrivals_session
+    #The session of the coordinator, if any, belongs to its own loop
+    arrivals_session = None
+    worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(worker_loop)
+
+def collect_shard(assignments,requested_lines,burst,retry_hits) :
+    """
+    Performs the requests of a shard of the burst in a worker process.
+    Returns the result of collect_stops and the metrics of the shard
+
+        Parameters
+        ----------
+        assignments : list
+            List of (stop, account, token) tuples of the accounts of the shard
+        requested_lines : list
+            List with the desired line ids
+        burst : int
+            Number of the burst in the day
+        retry_hits : dict
+            Hits left in every account of the shard for the retries
+    """
+    metrics = BurstMetrics(burst)
+    columns,stop_etas,spent_accounts,retries_spent = worker_loop.run_until_complete(collect_stops(assignments,requested_lines,metrics,retry_hits))
+    return columns,stop_etas,spent_accounts,retries_spent,metrics
+
+def get_arrival_data(requested_lines,tick_drift=0,skipped_ticks=0) :
+    """
+    Returns the data of all the buses inside the requested lines
+
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+        tick_drift : float
+            Seconds the burst was fired after it was due
+        skipped_ticks : int
+            Ticks skipped because the previous burst was too slow
+    """
+    global day_burst
+
+    #We increase the day burst by one
+    day_burst = day_burst + 1
+    metrics = BurstMetrics(day_burst)
+    metrics.tick_drift,metrics.skipped_ticks = tick_drift,skipped_ticks
 
-        print('Burst {} - There were {} ok responses and {} not okey responses - {}'.format(day_burst,n_ok_answers,n_not_ok_answers,datetime.datetime.now()))
-        print('{} new rows appended to {}\n'.format(buses_df.shape[0],f))
+    #We get the list of stops to ask for
+    stops_of_lines = get_stops_of_lines(requested_lines)
+    burst_time = datetime.datetime.now()
+    if ADAPTIVE_POLLING :
+        stops_of_lines = get_stops_scheduler(requested_lines).due_stops(stops_of_lines,burst_time)
+
+    #Spread the stops among the accounts with hits left
+    assignments = hits_budget.assign(stops_of_lines)
+    if len(assignments) < len(stops_of_lines) :
+        print('Only {} of {} stops fit in the hits left - {}\n'.format(len(assignments),len(stops_of_lines),datetime.datetime.now()))
+    #Hits the accounts have left for the retries, every account is used by a single shard
+    retry_hits = hits_budget.retry_hits([account for stop,account,token in assignments])
+
+    if shards_pool is None :
+        #We submit the burst to the collector loop and wait until it is complete
+        future = asyncio.run_coroutine_threadsafe(collect_stops(assignments,requested_lines,metrics,retry_hits),get_collector_loop())
+        columns,stop_etas,spent_accounts,retries_spent = future.result()
+    else :
+        #Every worker performs the requests of the stops assigned to its accounts
+        shards = [[] for shard in range(N_SHARDS)]
+        for assignment in assignments :
+            shards[assignment[1] % N_SHARDS].append(assignment)
+        results = shards_pool.starmap(collect_shard,[(shard,requested_lines,day_burst,
+                                                      {account : retry_hits[account] for stop,account,token in shard})
+                                                     for shard in shards if len(shard) > 0])
+
+        #And we merge their rows into a single burst
+        columns,stop_etas,spent_accounts,retries_spent = {key : [] for key in burst_keys},{},set(),{}
+        for shard_columns,shard_stop_etas,shard_spent_accounts,shard_retries_spent,shard_metrics in results :
+            for key in burst_keys :
+                columns[key].extend(shard_columns[key])
+            stop_etas.update(shard_stop_etas)
+            spent_accounts.update(shard_spent_accounts)
+            retries_spent.update(shard_retries_spent)
+            metrics.merge(shard_metrics)
+
+    for account,hits in retries_spent.items() :
+        hits_budget.spend(account,hits)
+    for account in spent_accounts :
+        hits_budget.exhausted(account)
+    get_burst_hits(requested_lines).append(len(assignments) + sum(retries_spent.values()))
+    if ADAPTIVE_POLLING :
+        stops_scheduler = get_stops_scheduler(requested_lines)
+        interval = polling_interval(requested_lines,burst_time)
+        for stopId,etas in stop_etas.items() :
+            stops_scheduler.update(stopId,etas,burst_time,interval)
+
+    #Return None if we could not gather any data
+    if (len(columns['bus']) == 0) and (hits_budget.total_remaining() == 0) :
+        metrics.finish()
+        metrics_registry.record(metrics)
+        return None
+
+    #We create the dataframe of the buses
+    start = time.perf_counter()
+    buses_df = drop_duplicates(pd.DataFrame(columns, columns=burst_keys))
+    #The raw data only gets the observations that changed, the burst published is complete
+    raw_df = delta_filter.filter(buses_df) if RAW_DELTAS else buses_df
+    metrics.parse_time += time.perf_counter() - start
+    metrics.rows = buses_df.shape[0]
+    metrics.raw_rows = raw_df.shape[0]
+
+    start = time.perf_counter()
+
+    #And we queue the data to be appended to the raw data files by the writer thread
+    raw_spool.put(raw_df)
+
+    #Publish the burst for the real time consumers, with the last rows of the stops not polled
+    if ADAPTIVE_POLLING :
+        buses_df = get_stops_scheduler(requested_lines).fill_burst(buses_df,stop_etas.keys(),burst_time)
+    burst_id = publish_burst(buses_df)
+    metrics.write_time = time.perf_counter() - start
+    metrics.finish()
+    metrics_registry.record(metrics)
+
+    print('Burst {} ({}) - There were {} ok responses and {} not okey responses - {}'.format(metrics.burst,burst_id,metrics.ok,metrics.not_ok,datetime.datetime.now()))
+    print('{} rows, {} new rows queued to the raw data - Burst took {} seconds\n'.format(buses_df.shape[0],raw_df.shape[0],round(metrics.wall_time,3)))
 
 
 #Global vars
 from api_credentials import emails,passwords,XClientId,passKey
-account_index = 0
-accessToken = ''
-out_of_hits = True
+from hits_budget import HitsBudget
+from stops_scheduler import StopsScheduler
+from arrow_storage import DayPartitionedWriter, write_burst
+from collector_metrics import BurstMetrics, MetricsRegistry
+from raw_spool import RawSpool
+from delta_filter import DeltaFilter, drop_duplicates
+from burst_scheduler import BurstScheduler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Common'))
+from burst_ring import open_ring
+hits_budget = None
 day_burst = 0
+metrics_registry = MetricsRegistry(METRICS_FILE)
+delta_filter = DeltaFilter(DELTA_MAX_AGE)
+raw_spool = RawSpool(write_raw_data,RAW_SPOOL_DIR,RAW_QUEUE_SIZE,RAW_BATCH_SIZE)
+
+#Normal buses hours range
+start_time_day = datetime.time(7,0,0)
+end_time_day = datetime.time(23,0,0)
+#Night buses hours range
+start_time_night = datetime.time(0,0,0)
+end_time_night = datetime.time(5,30,0)
+
+def service_windows(date) :
+    """
+    Returns the (start, end, requested_lines) service windows of the day
 
-def main():
-    global account_index
-    global accessToken
-    global out_of_hits
+        Parameters
+        ----------
+        date : date
+            The day
+    """
+    windows = [(
+        datetime.datetime.combine(date,start_time_day),
+        datetime.datetime.combine(date,end_time_day),
+        get_requested_lines(DAY_LINES)
+    )]
+    #Night buses are collected in the weekend
+    if date.weekday() in [5,6] :
+        windows.append((
+            datetime.datetime.combine(date,start_time_night),
+            datetime.datetime.combine(date,end_time_night),
+            get_requested_lines(NIGHT_LINES,night=True)
+        ))
+    return windows
+
+def service_seconds_left(now) :
+    """
+    Returns the seconds of data collection left until the end of the day,
+    when the hits of the accounts are renewed
+
+        Parameters
+        ----------
+        now : datetime
+            Current datetime
+    """
+    seconds_left = 0
+    for start,end,requested_lines in service_windows(now.date()) :
+        seconds_left += max((end - max(start,now)).total_seconds(),0)
+    return seconds_left
+
+#Hits spent by the last bursts of each set of requested lines
+bursts_hits = {}
+
+def get_burst_hits(requested_lines) :
+    """
+    Returns the hits spent by the last bursts of the requested lines
+
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+    """
+    key = tuple(requested_lines)
+    if key not in bursts_hits :
+        bursts_hits[key] = deque(maxlen=HITS_WINDOW)
+    return bursts_hits[key]
+
+def polling_interval(requested_lines,now) :
+    """
+    Returns the polling interval that makes the hits left last for the rest of the day,
+    from the mean hits spent by the last bursts, or all the stops if there are none yet
+
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+        now : datetime
+            Current datetime
+    """
+    burst_hits = get_burst_hits(requested_lines)
+    if len(burst_hits) > 0 :
+        n_requests = sum(burst_hits)/len(burst_hits)
+    else :
+        n_requests = len(get_stops_of_lines(requested_lines))
+    interval = hits_budget.interval(n_requests,service_seconds_left(now))
+    return interval if interval != None else hits_budget.max_interval
+
+def collect_burst(requested_lines,tick_drift,skipped_ticks) :
+    """
+    Performs a burst if any of the accounts has hits left
+
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+        tick_drift : float
+            Seconds the burst was fired after it was due
+        skipped_ticks : int
+            Ticks skipped because the previous burst was too slow
+    """
+    #The hits of the accounts are renewed every day
+    if hits_budget.needs_refresh() :
+        hits_budget.refresh()
+
+    #If we have lost all the hits we wait for the next tick, at the longest interval
+    if hits_budget.total_remaining() == 0 :
+        print('None of the accounts has hits available - {}\n'.format(datetime.datetime.now()))
+        hits_budget.refresh()
+        return
+
+    get_arrival_data(requested_lines,tick_drift,skipped_ticks)
+
+def end_day_bursts() :
+    """
+    Restarts the count of bursts when a service window ends
+    """
     global day_burst
+    day_burst = 0
 
-    rt_started = False
-
-    #Initial value of accessToken
-    for i in range(0,5) :
-        account_index = i
-
-        #Try until we get response to the login without errors
-        json_response = 'Error'
-        while json_response == 'Error' :
-            json_response = get_access_token(emails[account_index],passwords[account_index])
-
-        if json_response['code'] == '98' :
-            print('Account {} has no hits available\n'.format(account_index))
-            if i == 4 :
-                print('None of the accounts has hits available\n')
-                i = 0
-            else :
-                pass
-        elif (json_response['code'] == '00') | (json_response['code'] == '01') :
-            accessToken = json_response['data'][0]['accessToken']
-            print('Making requests from account {} - accessToken : {}\n'.format(account_index,accessToken))
-            out_of_hits = False
-            break
-
-    #Normal buses hours range
-    start_time_day = datetime.time(7,0,0)
-    end_time_day = datetime.time(23,0,0)
-    #Night buses hours range
-    start_time_night = datetime.time(0,0,0)
-    end_time_night = datetime.time(5,30,0)
-
-    while True :
-        #Retrieve data every interval seconds if we are between 6:00 and 23:30
-        now = datetime.datetime.now()
-
-        #If we have lost all the hits
-        if out_of_hits :
-            #Wait until we have hits available again
-            if ( (now.weekday() in [0,1,2,3,4]) & (time_in_range(start_time_day,end_time_day,now.time())) ) | (now.weekday() in [5,6]) :
-                for i in range(0,5) :
-                    account_index = i
-
-                    #Try until we get response to the login without errors
-                    json_response = 'Error'
-                    while json_response == 'Error' :
-                        json_response = get_access_token(emails[account_index],passwords[account_index])
-
-                    if json_response['code'] == '98' :
-                        print('Account {} has no hits available\n'.format(account_index))
-                        if i == 4 :
-                            print('None of the accounts has hits available - Sleeping 10 minutes - {}\n'.format(datetime.datetime.now()))
-                            i = 0
-                            if rt_started :
-                                print('Stop retrieving data - {}'.format(datetime.datetime.now()))
-                                rt.stop()
-                                rt_started = False
-                            time.sleep(600)
-                        else :
-                            pass
-                    elif (json_response['code'] == '00') | (json_response['code'] == '01') :
-                        accessToken = json_response['data'][0]['accessToken']
-                        print('Making requests from account {} - accessToken : {}\n'.format(account_index,accessToken))
-                        out_of_hits = False
-                        break
-            else :
-                #We wait 10 minutes
-                time.sleep(600)
-            #We pass directly to next iteration
-            continue
+def main():
+    global hits_budget
+    global shards_pool
+
+    #Start the worker processes before any other thread, they are forked from this one
+    if N_SHARDS > 1 :
+        shards_pool = multiprocessing.Pool(N_SHARDS, initializer=init_shard_worker)
+        print('Collecting with {} worker processes - {}\n'.format(N_SHARDS,datetime.datetime.now()))
+
+    #Write the bursts left in the spool by the last run and start the raw data writer
+    raw_spool.start()
+
+    #Serve the metrics of the bursts from the collector loop
+    try :
+        asyncio.run_coroutine_threadsafe(metrics_registry.start_server(METRICS_PORT),get_collector_loop()).result()
+    except Exception as e :
+        print('Metrics endpoint not available - {} - {}\n'.format(e,datetime.datetime.now()))
+
+    #Log in every account and read the hits they have left
+    hits_budget = HitsBudget(
+        len(emails),
+        lambda account : get_access_token(emails[account],passwords[account],account == 0)
+    )
+    hits_budget.refresh()
 
-        #If we are not in the weekend
-        if now.weekday() in [0,1,2,3,4] :
-            #Retrieve data from lines 1,44,82,132,133 - 272 Stops
-            if time_in_range(start_time_day,end_time_day,now.time()) :
-                if not rt_started :
-                    print('Retrieve data from lines 1,44,82,132,133 - 272 Stops - {}\n'.format(datetime.datetime.now())) #91(F),92(G),99(U)
-                    requested_lines = [1,44,82,132,133]
-                    rt = RepeatedTimer(50, get_arrival_data, requested_lines)
-                    rt_started = True
-            else :
-                #Stop timer if it exists
-                if rt_started :
-                    print('Stop retrieving data from lines 1,44,82,132,133 - 272 Stops - {}\n'.format(datetime.datetime.now()))
-                    rt.stop()
-                    rt_started = False
-                    day_burst = 0
-        #If we are in Saturday or Sunday
-        else :
-            #Retrieve data from lines 1,44,82,132,133 - 272 Stops
-            if time_in_range(start_time_day,end_time_day,now.time()) :
-                if not rt_started :
-                    print('Retrieve data from lines 1,44,82,132,133 - 272 Stops - {}\n'.format(datetime.datetime.now()))
-                    requested_lines = [1,44,82,132,133]
-                    rt = RepeatedTimer(60, get_arrival_data, requested_lines)
-                    rt_started = True
-            #Retrieve data from lines 502,506 - 131 Stops
-            elif time_in_range(start_time_night,end_time_night,now.time()) :
-                if not rt_started :
-                    print('Retrieve data from lines 502,506 - 131 Stops - {}\n'.format(datetime.datetime.now()))
-                    requested_lines = [502,506]
-                    rt = RepeatedTimer(70, get_arrival_data, requested_lines)
-                    rt_started = True
-            else :
-                #Stop timer if it exists
-                if rt_started :
-                    print('Stop retrieving data for weekends - {}\n'.format(datetime.datetime.now()))
-                    rt.stop()
-                    rt_started = False
-                    day_burst = 0
-
-        #Wait 10 seconds till next loop (no need to run the loop faster)
-        time.sleep(10)
+    #Fire the bursts inside the service windows, spending the hits left evenly over the rest of the day
+    scheduler = BurstScheduler(service_windows,collect_burst,polling_interval,end_day_bursts)
+    scheduler.run()
 
 if __name__== "__main__":
     main()
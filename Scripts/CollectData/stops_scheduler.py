@@ -0,0 +1,164 @@
+import datetime
+from datetime import timedelta
+from threading import Lock
+
+import pandas as pd
+
+#Buses closer than this number of seconds to a stop make it be polled every burst
+IMMINENT_TIME = 180
+#Maximum seconds a stop can go without being polled
+MAX_DELAY = 600
+#Maximum seconds between two observations of a bus at a stop, below the 600 seconds
+#after which add_arrival_time_estim in preprocess_clean starts a new trip
+MAX_GAP = 570
+#Stops due in less than this number of seconds are polled in the current burst
+DUE_TOLERANCE = 15
+
+class StopsScheduler(object):
+    '''
+    Decides which stops are polled in each burst. Stops with buses about to
+    arrive are polled every burst, while the ones without buses approaching
+    and the terminal stops are polled less often, depending on the time left
+    for the nearest bus and on the frequency of the lines in freq_ranges_dict.
+    The last rows answered by every stop are kept, so the bursts published
+    are completed with the stops that were not polled.
+    '''
+    def __init__(self, requested_lines, line_stops_dict, freq_ranges_dict, line_sns_dict):
+        '''
+        Parameters
+        ----------
+        requested_lines : list
+            List with the desired line ids
+        line_stops_dict : dict
+            Stops of each direction of the lines by line id
+        freq_ranges_dict : dict
+            Frequency ranges in minutes of the lines by line short name
+        line_sns_dict : dict
+            Line short name of each line id
+        '''
+        self.freq_ranges_dict = freq_ranges_dict
+        self.next_poll        = {}
+        self.last_rows        = {}
+        self.lock             = Lock()
+
+        #Lines passing through every stop and terminal stops
+        self.stop_lines = {}
+        self.terminals = set()
+        for line_id in requested_lines :
+            line_sn = line_sns_dict.get(line_id,str(line_id))
+            line_stops = line_stops_dict[str(line_id)]
+            if line_stops == None :
+                continue
+            for direction in ['1','2'] :
+                stops = line_stops.get(direction)
+                if stops == None or len(stops) == 0 :
+                    continue
+                self.terminals.update([str(stops[0]),str(stops[-1])])
+                for stop in stops :
+                    self.stop_lines.setdefault(str(stop),set()).add(line_sn)
+
+    def min_headway(self, stop, now):
+        '''
+        Returns the minimum headway in seconds of the lines passing through
+        the stop at the current time, or MAX_DELAY if it is not known
+        '''
+        if now.weekday() in [0,1,2,3,4] :
+            day_type = 'LA'
+        elif now.weekday() == 5 :
+            day_type = 'SA'
+        else :
+            day_type = 'FE'
+
+        headways = []
+        for line_sn in self.stop_lines.get(str(stop),[]) :
+            line_freqs = self.freq_ranges_dict.get(line_sn,{})
+            #Night lines have their ranges by direction instead of by day type
+            if day_type in line_freqs :
+                ranges = line_freqs[day_type]
+            else :
+                ranges = sum(line_freqs.values(),[])
+            for freq in ranges :
+                if freq['time_range'][0] <= now.hour < freq['time_range'][1] :
+                    headways.append(60*freq['freq_range'][0])
+        return min(headways) if len(headways) > 0 else MAX_DELAY
+
+    def due_stops(self, stops, now):
+        '''
+        Returns the stops that have to be polled in the burst
+
+        Parameters
+        ----------
+        stops : list
+            All the stops of the requested lines
+        now : datetime
+            Time of the burst
+        '''
+        limit = now + timedelta(seconds=DUE_TOLERANCE)
+        with self.lock :
+            return [stop for stop in stops if self.next_poll.get(str(stop),now) <= limit]
+
+    def update(self, stop, etas, now, interval=0):
+        '''
+        Sets the next time the stop has to be polled from the estimated
+        arrival times of the buses approaching it. The stop is polled in the
+        first burst after that time, so the delay leaves room for an interval
+        between bursts before the gap between observations reaches MAX_GAP
+
+        Parameters
+        ----------
+        stop : str
+            The stop code
+        etas : list
+            Values of estimateArrive of the buses of the stop in seconds
+        now : datetime
+            Time of the burst
+        interval : float
+            Seconds between bursts
+        '''
+        max_gap = max(min(MAX_DELAY,MAX_GAP - interval),0)
+        max_delay = min(self.min_headway(stop,now)/2,max_gap)
+        if len(etas) > 0 :
+            #Poll again when the nearest bus is about to arrive
+            delay = min(max(min(etas) - IMMINENT_TIME,0),max_delay)
+        else :
+            #No buses approaching, a new one cannot arrive in less than a headway
+            delay = max_delay
+        #Terminal stops only give the buses that start or end their trips
+        if str(stop) in self.terminals :
+            delay = min(2*max(delay,max_delay/2),max_gap)
+
+        with self.lock :
+            self.next_poll[str(stop)] = now + timedelta(seconds=delay)
+
+    def fill_burst(self, buses_df, answered_stops, now):
+        '''
+        Keeps the rows of the stops answered in the burst and returns the burst
+        with the last rows of the stops that were not polled. Their estimateArrive
+        is moved to the time of the burst, keeping the arrival time estimated,
+        and the buses that should have already arrived are left out
+
+        Parameters
+        ----------
+        buses_df : DataFrame
+            Burst of data of the stops polled
+        answered_stops : iterable
+            Stops polled that answered, with or without buses
+        now : datetime
+            Time of the burst
+        '''
+        stop_rows = buses_df.groupby(buses_df.stop.astype(str)).indices if buses_df.shape[0] > 0 else {}
+        answered_stops = set([str(stop) for stop in answered_stops])
+        with self.lock :
+            for stop in answered_stops :
+                self.last_rows[stop] = buses_df.iloc[stop_rows.get(stop,[])]
+            carried = [rows for stop,rows in self.last_rows.items() if (stop not in answered_stops) and (rows.shape[0] > 0)]
+        if len(carried) == 0 :
+            return buses_df
+
+        carried_df = pd.concat(carried, ignore_index=True)
+        elapsed = (pd.Timestamp(now) - pd.to_datetime(carried_df.datetime)).dt.total_seconds()
+        carried_df['estimateArrive'] = (carried_df.estimateArrive - elapsed).round().astype(int)
+        carried_df['datetime'] = pd.Timestamp(now)
+        #Rows older than any stop can go without being polled are not trusted
+        carried_df = carried_df.loc[(elapsed.values < MAX_DELAY) & (carried_df.estimateArrive.values >= 0)]
+        return pd.concat([buses_df,carried_df], ignore_index=True)
@@ -0,0 +1,245 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from bus_schema import data_dir, categories
+
+#Columns of the rings and their types
+burst_schema = [
+    ('line','category'),
+    ('destination','category'),
+    ('stop','uint16'),
+    ('bus','uint16'),
+    ('datetime','datetime64[ns]'),
+    ('estimateArrive','int32'),
+    ('DistanceBus','int32')
+]
+headways_schema = [
+    ('datetime','datetime64[ns]'),
+    ('line','category'),
+    ('direction','uint16'),
+    ('busA','uint16'),
+    ('busB','uint16'),
+    ('hw_pos','uint16'),
+    ('headway','int32'),
+    ('busB_ttls','int32')
+]
+
+#Rings shared between the collector, the detector and the dashboard
+rings_schemas = {
+    'bursts': burst_schema, #Bursts published by the collector
+    'bursts_c': burst_schema, #Bursts cleaned by the detector
+    'headways': headways_schema #Headways of the last bursts
+}
+
+#Header fields
+MAGIC = 0x454D5452494E4732 #EMTRING2, codes of the sorted categories
+H_MAGIC,H_SLOTS,H_ROWS,H_ROW_BYTES,H_LAST_SLOT,H_LAST_ID = range(6)
+HEADER_FIELDS = 8
+#Slot header fields
+S_SEQ,S_ID,S_ROWS = range(3)
+SLOT_FIELDS = 4
+
+
+class BurstRing(object):
+    '''
+    Ring buffer with the last bursts of data stored as typed column arrays in
+    a memory mapped file, shared by the processes of the real time pipeline.
+    The writer sets the sequence number of a slot to an odd number before
+    filling it and to the next even one after, so readers can tell if they
+    read a slot while it was being written and retry. A ring with another
+    layout is replaced by a new file, never truncated, and the readers map
+    the new file when they see it.
+    '''
+    def __init__(self, path, schema, n_slots=16, slot_rows=50000):
+        '''
+        Parameters
+        ----------
+        path : str
+            File of the ring
+        schema : list
+            List of (column, dtype) tuples, with 'category' for the string
+            columns with the categories of the categories dictionary
+        n_slots : int
+            Number of bursts kept
+        slot_rows : int
+            Maximum number of rows of a burst
+        '''
+        self.path      = path
+        self.schema    = schema
+        self.n_slots   = n_slots
+        self.slot_rows = slot_rows
+        #Categories are stored as their codes and dates as epoch nanoseconds
+        self.dtypes    = [(name, np.dtype('int16') if dtype == 'category' else \
+                                 np.dtype('int64') if dtype.startswith('datetime64') else np.dtype(dtype)) for name,dtype in schema]
+        self.row_bytes = sum([dtype.itemsize for name,dtype in self.dtypes])
+        self.mm        = None
+        self.inode     = None
+
+    def _layout(self):
+        header_bytes = 8*(HEADER_FIELDS + SLOT_FIELDS*self.n_slots)
+        return header_bytes, header_bytes + self.n_slots*self.slot_rows*self.row_bytes
+
+    def attach(self, create=False):
+        '''
+        Maps the file of the ring and returns true if it could be attached
+
+        Parameters
+        ----------
+        create : bool
+            Create the file if it does not exist or has another layout.
+            Only the writer of the ring creates it
+        '''
+        if self.mm is not None :
+            #Map the ring again if its file was replaced
+            try :
+                if os.stat(self.path).st_ino == self.inode :
+                    return True
+            except FileNotFoundError :
+                return True
+            self.mm = None
+        header_bytes,size = self._layout()
+        layout = [MAGIC,self.n_slots,self.slot_rows,self.row_bytes]
+        if os.path.isfile(self.path) and os.path.getsize(self.path) == size :
+            #Inode taken before mapping, a file replaced in between is mapped again the next time
+            inode = os.stat(self.path).st_ino
+            mm = np.memmap(self.path, dtype='uint8', mode='r+' if create else 'r', shape=(size,))
+            if np.frombuffer(mm, dtype='int64', count=4).tolist() != layout :
+                del mm
+                mm = None
+        else :
+            mm = None
+
+        if mm is None :
+            if not create :
+                return False
+            #Write a new empty ring and rename it, other processes may have the old file mapped
+            mm = np.memmap(self.path+'.tmp', dtype='uint8', mode='w+', shape=(size,))
+            header = np.ndarray((HEADER_FIELDS,), dtype='int64', buffer=mm)
+            header[H_MAGIC:H_ROW_BYTES+1] = layout
+            header[H_LAST_SLOT] = -1
+            header[H_LAST_ID] = -1
+            mm.flush()
+            del header,mm
+            os.replace(self.path+'.tmp',self.path)
+            inode = os.stat(self.path).st_ino
+            mm = np.memmap(self.path, dtype='uint8', mode='r+', shape=(size,))
+
+        self.mm = mm
+        self.inode = inode
+        self.header = np.ndarray((HEADER_FIELDS,), dtype='int64', buffer=mm)
+        self.slots = np.ndarray((self.n_slots,SLOT_FIELDS), dtype='int64', buffer=mm, offset=8*HEADER_FIELDS)
+        #Column arrays of every slot
+        self.columns = []
+        offset = header_bytes
+        for slot in range(self.n_slots) :
+            slot_columns = {}
+            for name,dtype in self.dtypes :
+                slot_columns[name] = np.ndarray((self.slot_rows,), dtype=dtype, buffer=mm, offset=offset)
+                offset += dtype.itemsize*self.slot_rows
+            self.columns.append(slot_columns)
+        return True
+
+    def last_id(self):
+        '''
+        Returns the id of the last burst written, or None if the ring is empty or not available
+        '''
+        if not self.attach() :
+            return None
+        last_id = int(self.header[H_LAST_ID])
+        return last_id if last_id >= 0 else None
+
+    def write(self, burst_id, df):
+        '''
+        Writes the burst in the oldest slot of the ring. Rows with values
+        outside the categories are left out, none of the consumers can use them
+
+        Parameters
+        ----------
+        burst_id : int
+            Sequence number of the burst
+        df : DataFrame
+            Burst of data with the columns of the schema
+        '''
+        self.attach(create=True)
+
+        #Encode the columns
+        encoded,valid = {},np.ones(df.shape[0], dtype=bool)
+        for name,dtype in self.schema :
+            if dtype == 'category' :
+                codes = pd.Categorical(df[name], categories=categories[name]).codes
+                valid &= codes >= 0
+                encoded[name] = codes
+            elif dtype.startswith('datetime64') :
+                encoded[name] = pd.to_datetime(df[name]).values.astype('datetime64[ns]').view('int64')
+            else :
+                encoded[name] = df[name].values
+        n_rows = int(valid.sum())
+        if n_rows > self.slot_rows :
+            print('Burst {} has {} rows, only the first {} fit in the ring\n'.format(burst_id,n_rows,self.slot_rows))
+            n_rows = self.slot_rows
+
+        slot = (int(self.header[H_LAST_SLOT]) + 1) % self.n_slots
+        #Odd sequence number while writing, set instead of incremented so a writer
+        #that died in the middle of a slot does not leave it even
+        seq = int(self.slots[slot,S_SEQ]) | 1
+        self.slots[slot,S_SEQ] = seq
+        for name,dtype in self.dtypes :
+            self.columns[slot][name][:n_rows] = encoded[name][valid][:n_rows].astype(dtype)
+        self.slots[slot,S_ID] = burst_id
+        self.slots[slot,S_ROWS] = n_rows
+        self.slots[slot,S_SEQ] = seq + 1
+        #Publish the slot
+        self.header[H_LAST_SLOT] = slot
+        self.header[H_LAST_ID] = burst_id
+
+    def read(self, burst_id=None, retries=5):
+        '''
+        Returns the burst as a DataFrame, or None if it is not in the ring
+
+        Parameters
+        ----------
+        burst_id : int
+            Sequence number of the burst, the last one if None
+        '''
+        if not self.attach() :
+            return None
+        for retry in range(retries) :
+            if burst_id is None :
+                slot = int(self.header[H_LAST_SLOT])
+            else :
+                found = np.nonzero(self.slots[:,S_ID] == burst_id)[0]
+                slot = int(found[0]) if len(found) > 0 else -1
+            if slot < 0 :
+                return None
+
+            seq = int(self.slots[slot,S_SEQ])
+            if seq % 2 == 1 :
+                continue
+            n_rows = int(self.slots[slot,S_ROWS])
+            read_id = int(self.slots[slot,S_ID])
+            data = {name : np.array(self.columns[slot][name][:n_rows]) for name,dtype in self.dtypes}
+            #Check the slot was not overwritten while copying it
+            if int(self.slots[slot,S_SEQ]) != seq or ((burst_id is not None) and (read_id != burst_id)) :
+                continue
+
+            #Decode the columns
+            df = {}
+            for name,dtype in self.schema :
+                if dtype == 'category' :
+                    df[name] = pd.Categorical.from_codes(data[name], categories=categories[name])
+                elif dtype.startswith('datetime64') :
+                    df[name] = pd.to_datetime(data[name])
+                else :
+                    df[name] = data[name]
+            return pd.DataFrame(df, columns=[name for name,dtype in self.schema])
+        return None
+
+
+def open_ring(name):
+    '''
+    Returns the ring of the real time pipeline with the name passed, one of
+    'bursts', 'bursts_c' or 'headways'
+    '''
+    return BurstRing(os.path.join(data_dir,'RealTime',name+'.ring'), rings_schemas[name])
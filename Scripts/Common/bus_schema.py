@@ -0,0 +1,94 @@
+import os
+import json
+
+import pandas as pd
+
+#Directories of the data, relative to this file so every process finds them
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','Data')
+
+#Lines collected dictionary, gives the categories of the string columns
+with open(os.path.join(data_dir,'Static','lines_collected_dict.json'), 'r') as f:
+    lines_collected_dict = json.load(f)
+
+#Lines and destinations collected, sorted so the codes keep the order of the strings
+line_categories = sorted(lines_collected_dict.keys())
+destination_categories = sorted(set(sum([lines_collected_dict[line]['destinations'] for line in line_categories],[])))
+categories = {
+    'line': line_categories,
+    'destination': destination_categories
+}
+
+#Types of the columns of the bus observations and of the data derived from them.
+#Lines and destinations are stored as codes of the collected ones, any other
+#value is read as nan, and dates as datetime64[ns], nanoseconds since the epoch
+bus_dtypes = {
+    'line': pd.CategoricalDtype(line_categories),
+    'destination': pd.CategoricalDtype(destination_categories),
+    'stop': 'uint16',
+    'bus': 'uint16',
+    'given_coords': 'bool',
+    'pos_in_burst':'uint16',
+    'estimateArrive': 'int32',
+    'DistanceBus': 'int32',
+    'request_time': 'int32',
+    'lat':'float32',
+    'lon':'float32',
+    'direction': 'uint16',
+    'busA': 'uint16',
+    'busB': 'uint16',
+    'hw_pos': 'uint16',
+    'headway': 'int32',
+    'busB_ttls': 'int32'
+}
+
+#Format of the dates written to the csv files
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def schema_dtypes(columns) :
+    '''
+    Returns the types of the schema of the columns given
+
+    Parameters
+    ----------------
+    columns : list
+        Columns of the data
+    '''
+    return {column: bus_dtypes[column] for column in columns if column in bus_dtypes}
+
+
+def to_schema(df) :
+    '''
+    Returns the dataframe with its columns converted to the types of the schema,
+    for the data that does not come from a csv, like the Arrow or feather files
+
+    Parameters
+    ----------------
+    df : DataFrame
+        Dataframe to convert
+    '''
+    #is_dtype_equal, comparing an object dtype with a categorical one raises in older numpy
+    dtypes = {column: dtype for column,dtype in schema_dtypes(df.columns).items() if not pd.api.types.is_dtype_equal(df[column].dtype,dtype)}
+    return df.astype(dtypes) if len(dtypes) > 0 else df
+
+
+def read_buses_csv(f, columns, date_columns=['datetime'], date_format=DATE_FORMAT) :
+    '''
+    Returns the columns of the csv file with the types of the schema, reading
+    only those columns and parsing the strings straight into categories
+
+    Parameters
+    ----------------
+    f : str
+        Path of the file
+    columns : list
+        Columns to read
+    date_columns : list
+        Columns with dates to parse
+    date_format : str
+        Format of the dates, None to infer it
+    '''
+    df = pd.read_csv(f, dtype=schema_dtypes(columns), usecols=columns)[columns]
+    for column in date_columns :
+        df[column] = pd.to_datetime(df[column], format=date_format)
+    return df
@@ -0,0 +1,74 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+#Directories of the data, relative to this file so every process finds them
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','Data')
+
+#Lines collected dictionary
+with open(os.path.join(data_dir,'Static','lines_collected_dict.json'), 'r') as f:
+    lines_collected_dict = json.load(f)
+
+#Lookup arrays of the cleaning conditions, one position for every line and destination.
+#The direction of a destination is 1 if it is the second one of the line
+line_dest_keys,line_dest_lengths,line_dest_stops = [],[],[]
+for line,line_dict in lines_collected_dict.items() :
+    for dest in line_dict['destinations'] :
+        direction = '1' if dest == line_dict['destinations'][1] else '2'
+        line_dest_keys.append((line,dest))
+        line_dest_lengths.append(int(line_dict[direction]['length']))
+        line_dest_stops.append([int(stop) for stop in line_dict[direction]['stops']])
+line_dest_index = pd.MultiIndex.from_tuples(line_dest_keys, names=['line','destination'])
+line_dest_lengths = np.array(line_dest_lengths, dtype='float64')
+#Valid stops table, a row for every line and destination and a column for every stop code
+max_stop = max([max(stops) for stops in line_dest_stops if len(stops) > 0])
+line_dest_valid_stops = np.zeros((len(line_dest_keys),max_stop+1), dtype=bool)
+for pos,stops in enumerate(line_dest_stops) :
+    line_dest_valid_stops[pos,stops] = True
+
+
+def clean_data(df) :
+    '''
+    Returns the dataframe without the rows that dont match the conditions specified
+
+    Parameters
+    ----------------
+    df : DataFrame
+        Dataframe to clean, with the line, destination, stop, DistanceBus
+        and estimateArrive columns
+    '''
+    if df.shape[0] == 0 :
+        return df.reset_index(drop=True)
+
+    #Position of the line and destination of every row, -1 if they are unknown
+    pos = line_dest_index.get_indexer(pd.MultiIndex.from_arrays([df.line.astype(str).values,df.destination.astype(str).values]))
+    known = pos >= 0
+    stop = df.stop.values.astype('int64')
+
+    #Line destination stop coherence condition
+    in_table = known & (stop >= 0) & (stop <= max_stop)
+    line_dest_stop_cond = np.zeros(df.shape[0], dtype=bool)
+    line_dest_stop_cond[in_table] = line_dest_valid_stops[pos[in_table],stop[in_table]]
+
+    #Length of the line in the direction of the row, nan if the line or destination are unknown
+    length = np.where(known, line_dest_lengths[pos], np.nan)
+
+    dist = df.DistanceBus.values
+    eta = df.estimateArrive.values
+
+    # DistanceBus values lower than the line length or negative
+    dist_cond = (dist >= 0) & (dist < length)
+
+    # estimateArrive values lower than the time it takes to go through the line at an speed
+    # of 2m/s, instantaneous speed lower than 120 km/h and positive values and time remaining lower than 2 hours
+    speed = 3.6*dist/np.where(eta > 0, eta, 1)
+    eta_cond = (eta > 0) & \
+               (eta < length/2) & \
+               (speed < 120) & \
+               (eta < 7200)
+
+    #Select rows that match the conditions
+    mask = line_dest_stop_cond & dist_cond & eta_cond
+    return df.loc[mask].reset_index(drop=True)
@@ -0,0 +1,119 @@
+import io
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from bus_schema import DATE_FORMAT, schema_dtypes
+
+def read_csv_days_from(f, offset, columns, dtype=None, date_columns=['datetime'], date_format=DATE_FORMAT,
+                       skip_days=None, block_size=64*1024*1024) :
+    '''
+    Reads the csv file in blocks of bytes from the offset given and yields its
+    data one day at a time, as ('YYYY-MM-DD', DataFrame, offset) tuples, with
+    the offset in bytes of the end of the last row of the day, so a later read
+    can start there without parsing the rows before it. The rows of the file
+    have to be in time order, like the ones appended by the collector or written
+    by the processing scripts, and one per line. A last line without its end of
+    line is a row still being written and is left for the next read
+
+    Parameters
+    ----------------
+    f : str
+        Path of the file
+    offset : int
+        Offset in bytes of the first row to read, 0 to read the whole file
+    columns : list
+        Columns to read
+    dtype : dict
+        Types of the columns, the ones of the bus schema if None
+    date_columns : list
+        Columns with dates to parse, the first one gives the day of the rows
+    date_format : str
+        Format of the dates
+    skip_days : set
+        Days, as 'YYYY-MM-DD' strings, that are left out
+    block_size : int
+        Bytes read at once
+    '''
+    dtype = dtype if dtype != None else schema_dtypes(columns)
+    skip_days = skip_days if skip_days != None else set()
+    yielded_days = set()
+
+    def day_dfs(df,ends) :
+        days = df[date_columns[0]].dt.strftime('%Y-%m-%d')
+        for day,rows in df.groupby(days, sort=True).indices.items() :
+            if day in skip_days :
+                continue
+            if day in yielded_days :
+                print('Rows of {} found out of time order in {} - {}\n'.format(day,f,datetime.datetime.now()))
+            yielded_days.add(day)
+            yield day,df.iloc[rows].reset_index(drop=True),int(ends[rows[-1]])
+
+    with open(f, 'rb') as f_csv :
+        header = f_csv.readline()
+        if not header.endswith(b'\n') :
+            return
+        offset = max(offset,len(header))
+        f_csv.seek(offset)
+
+        #Rows of the last day of the block and the offsets of their ends, it may continue in the next one
+        rest,rest_ends = None,None
+        partial_line = b''
+        while True :
+            data = f_csv.read(block_size)
+            if len(data) == 0 :
+                break
+            #Only the complete lines, the last one continues in the next block or is still being written
+            block = partial_line + data
+            cut = block.rfind(b'\n') + 1
+            block,partial_line = block[:cut],block[cut:]
+            if len(block) > 0 :
+                #Offset of the end of every line of the block, without the blank ones that are not read
+                chars = np.frombuffer(block, dtype='uint8')
+                ends = np.flatnonzero(chars == ord('\n')) + 1
+                starts = np.concatenate([[0],ends[:-1]])
+                blank = (ends - starts == 1) | ((ends - starts == 2) & (chars[starts] == ord('\r')))
+                ends = offset + ends[~blank]
+                offset += len(block)
+
+                chunk = pd.read_csv(io.BytesIO(header+block), dtype=dtype, usecols=columns)[columns]
+                for column in date_columns :
+                    chunk[column] = pd.to_datetime(chunk[column], format=date_format)
+                if rest is not None :
+                    chunk = pd.concat([rest,chunk], ignore_index=True)
+                    ends = np.concatenate([rest_ends,ends])
+                last_day = chunk[date_columns[0]].max().normalize()
+                complete = (chunk[date_columns[0]] < last_day).values
+                rest,rest_ends = chunk.loc[~complete].reset_index(drop=True),ends[~complete]
+                for day,day_df,day_end in day_dfs(chunk.loc[complete].reset_index(drop=True),ends[complete]) :
+                    yield day,day_df,day_end
+
+    if (rest is not None) and (rest.shape[0] > 0) :
+        for day,day_df,day_end in day_dfs(rest,rest_ends) :
+            yield day,day_df,day_end
+
+
+def read_csv_days(f, columns, dtype=None, date_columns=['datetime'], date_format=DATE_FORMAT,
+                  skip_days=None) :
+    '''
+    Reads the whole csv file and yields its data one day at a time, as
+    ('YYYY-MM-DD', DataFrame) tuples, so only a day of data is in memory
+
+    Parameters
+    ----------------
+    f : str
+        Path of the file
+    columns : list
+        Columns to read
+    dtype : dict
+        Types of the columns, the ones of the bus schema if None
+    date_columns : list
+        Columns with dates to parse, the first one gives the day of the rows
+    date_format : str
+        Format of the dates
+    skip_days : set
+        Days, as 'YYYY-MM-DD' strings, that are left out
+    '''
+    for day,day_df,_ in read_csv_days_from(f,0,columns,dtype,date_columns,date_format,skip_days) :
+        yield day,day_df
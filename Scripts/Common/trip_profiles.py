@@ -0,0 +1,229 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from bus_schema import data_dir, lines_collected_dict
+
+#Day types
+day_type_dict = { #0 = Monday, 1 = Tuesday ...
+    'LA' : [0,1,2,3,4], #LABORABLES
+    'LJ' : [0,1,2,3], #LUNES A JUEVES
+    'VV' : [4], #VIERNES
+    'SA' : [5], #SABADOS
+    'FE' : [6], #DOMIGOS O FESTIVOS
+}
+day_types = list(day_type_dict.keys())
+
+
+def headway_stops(line) :
+    '''
+    Returns the stops of both directions of the line where the headways are
+    calculated, in reverse order and without the first two and the last one
+
+    Parameters
+    ----------------
+    line : str
+        Line id
+    '''
+    stops1 = lines_collected_dict[line]['1']['stops'][-2::-1][0:-2]
+    stops2 = lines_collected_dict[line]['2']['stops'][-2::-1][0:-2]
+    return stops1,stops2
+
+
+class TripProfiles(object):
+    '''
+    Mean trip times between consecutive stops for every line, direction,
+    pair of stops, day type and hour, built once from the times between
+    stops. The mean trip times of an hour range and the mean times from
+    every stop to the last one of the headways are taken from them with
+    array indexing, and kept for the next bursts
+    '''
+    def __init__(self, keys, means, counts):
+        '''
+        Parameters
+        ----------
+        keys : DataFrame
+            Line, direction, stopA and stopB of every pair of stops, sorted
+        means : ndarray
+            Mean trip times, with shape (day types, 24 hours, keys)
+        counts : ndarray
+            Number of trip times, with the same shape
+        '''
+        self.keys   = keys.reset_index(drop=True)
+        self.means  = means
+        self.counts = counts
+        #Positions of the keys of every line
+        self.line_keys = {line: np.nonzero((self.keys.line == line).values)[0] for line in self.keys.line.unique()}
+        self.times_cache = {}
+
+    @classmethod
+    def build(cls, times_bt_stops):
+        '''
+        Returns the profiles of the times between stops
+
+        Parameters
+        ----------
+        times_bt_stops : DataFrame
+            Times between stops with the date parsed
+        '''
+        key_columns = ['line','direction','stopA','stopB']
+        keys = times_bt_stops[key_columns].drop_duplicates().sort_values(by=key_columns).reset_index(drop=True)
+        key_index = pd.MultiIndex.from_frame(keys)
+
+        means = np.zeros((len(day_types),24,keys.shape[0]), dtype='float32')
+        counts = np.zeros((len(day_types),24,keys.shape[0]), dtype='int32')
+        weekday = times_bt_stops.date.dt.weekday
+        for d,day_type in enumerate(day_types) :
+            day_type_df = times_bt_stops.loc[weekday.isin(day_type_dict[day_type])]
+            #Day types without data are left without counts, no mean is taken from them
+            if day_type_df.shape[0] == 0 :
+                continue
+            grouped = day_type_df.trip_time.groupby([day_type_df[column] for column in key_columns] + [day_type_df.st_hour])
+            agg = pd.DataFrame({'mean': grouped.mean(), 'count': grouped.count()}).reset_index()
+            hours = agg.st_hour.values.astype('int64')
+            pos = key_index.get_indexer(pd.MultiIndex.from_frame(agg[key_columns])).astype('int64')
+            means[d,hours,pos] = agg['mean'].values
+            counts[d,hours,pos] = agg['count'].values
+        return cls(keys,means,counts)
+
+    def save(self, f):
+        '''
+        Writes the profiles to a compressed numpy file, renaming a temporary file
+
+        Parameters
+        ----------
+        f : str
+            Path of the file
+        '''
+        with open(f+'.tmp', 'wb') as f_tmp :
+            np.savez_compressed(f_tmp,
+                line=self.keys.line.values.astype(str),
+                direction=self.keys.direction.values.astype('uint16'),
+                stopA=self.keys.stopA.values.astype('uint16'),
+                stopB=self.keys.stopB.values.astype('uint16'),
+                means=self.means,
+                counts=self.counts
+            )
+        os.replace(f+'.tmp',f)
+
+    @classmethod
+    def load(cls, f):
+        '''
+        Returns the profiles written to the file
+
+        Parameters
+        ----------
+        f : str
+            Path of the file
+        '''
+        with np.load(f) as data :
+            keys = pd.DataFrame({column: data[column] for column in ['line','direction','stopA','stopB']})
+            return cls(keys,data['means'],data['counts'])
+
+    def mean_times(self, line, day_type, hour_range):
+        '''
+        Returns a dict with the mean trip time from every stop of the line to
+        the next one, keyed by (direction, stopA). A stop followed by several
+        stops takes the first of them with data. The means of several hours
+        are weighted by their number of trip times
+
+        Parameters
+        ----------
+        line : str
+            Line id
+        day_type : str
+            Day type, one of the day type dict
+        hour_range : list
+            First hour and the hour after the last one
+        '''
+        pos = self.line_keys.get(line, np.array([], dtype='int64'))
+        d = day_types.index(day_type)
+        hour_means = self.means[d,hour_range[0]:hour_range[1]][:,pos]
+        hour_counts = self.counts[d,hour_range[0]:hour_range[1]][:,pos]
+        counts = hour_counts.sum(axis=0)
+        with_data = counts > 0
+        if hour_range[1] - hour_range[0] == 1 :
+            means = hour_means[0,with_data]
+        else :
+            means = ((hour_means*hour_counts).sum(axis=0)[with_data]/counts[with_data]).astype('float32')
+        keys = self.keys.iloc[pos[with_data]]
+
+        mean_times = {}
+        for direction,stopA,mean in zip(keys.direction.tolist(),keys.stopA.tolist(),means) :
+            if (direction,stopA) not in mean_times :
+                mean_times[(direction,stopA)] = mean
+        return mean_times
+
+    def times_to_stops(self, line, day_type, hour_range):
+        '''
+        Returns the list of the mean times from the stops of both directions
+        given by headway_stops to the first of them. The list ends at the first
+        stop without a mean trip time to the next one
+
+        Parameters
+        ----------
+        line : str
+            Line id
+        day_type : str
+            Day type, one of the day type dict
+        hour_range : list
+            First hour and the hour after the last one
+        '''
+        key = (line,day_type,hour_range[0],hour_range[1])
+        if key in self.times_cache :
+            return self.times_cache[key]
+
+        mean_times = self.mean_times(line,day_type,hour_range)
+        stops1,stops2 = headway_stops(line)
+        stops = stops1 + stops2
+        times,direction = [],1
+        for i in range(len(stops)) :
+            if i == 0 :
+                mean_time_to_stop = 0
+            elif i == len(stops1) :
+                mean_time_to_stop = 0
+                direction = 2
+            else :
+                mean = mean_times.get((direction,int(stops[i])))
+                if mean is None :
+                    break
+                mean_time_to_stop += mean
+            times.append(mean_time_to_stop)
+
+        self.times_cache[key] = times
+        return times
+
+
+def load_trip_profiles(f_csv=os.path.join(data_dir,'Processed','times_bt_stops.csv'),
+                       f=os.path.join(data_dir,'Processed','trip_profiles.npz')) :
+    '''
+    Returns the trip profiles, read from their file or built again from the
+    times between stops if they changed after the file was written
+
+    Parameters
+    ----------------
+    f_csv : str
+        Path of the times between stops
+    f : str
+        Path of the profiles
+    '''
+    if os.path.isfile(f) and ((not os.path.isfile(f_csv)) or (os.path.getmtime(f) >= os.path.getmtime(f_csv))) :
+        return TripProfiles.load(f)
+
+    times_bt_stops = pd.read_csv(f_csv,
+        dtype={
+            'line': 'str',
+            'direction': 'uint16',
+            'st_hour': 'uint16',
+            'stopA': 'uint16',
+            'stopB': 'uint16',
+            'trip_time':'float32'
+        },
+        usecols=['date','line','direction','st_hour','stopA','stopB','trip_time']
+    )
+    #Parse the dates
+    times_bt_stops['date'] = pd.to_datetime(times_bt_stops['date'], format='%Y-%m-%d')
+    trip_profiles = TripProfiles.build(times_bt_stops)
+    trip_profiles.save(f)
+    return trip_profiles
@@ -1,6 +1,9 @@
 import pandas as pd
+import numpy as np
 import json
 
+import os
+import sys
 import datetime
 from datetime import timedelta
 
@@ -10,34 +13,15 @@ from joblib import Parallel, delayed
 import multiprocessing
 num_cores = multiprocessing.cpu_count()
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Common'))
+from day_chunks import read_csv_days
+from trip_profiles import load_trip_profiles, headway_stops
+
 #Load line_stops_dict
 with open('../../Data/Static/lines_collected_dict.json', 'r') as f:
     lines_collected_dict = json.load(f)
-#Load times between stops data
-times_bt_stops = pd.read_csv('../../Data/Processed/times_bt_stops.csv',
-    dtype={
-        'line': 'str',
-        'direction': 'uint16',
-        'st_hour': 'uint16',
-        'end_hour': 'uint16',
-        'stopA': 'uint16',
-        'stopB': 'uint16',
-        'bus': 'uint16',
-        'trip_time':'float32',
-        'api_trip_time':'float32'
-    }
-)
-#Parse the dates
-times_bt_stops['date'] = pd.to_datetime(times_bt_stops['date'], format='%Y-%m-%d')
-
-#Day types
-day_type_dict = { #0 = Monday, 1 = Tuesday ...
-    'LA' : [0,1,2,3,4], #LABORABLES
-    'LJ' : [0,1,2,3], #LUNES A JUEVES
-    'VV' : [4], #VIERNES
-    'SA' : [5], #SABADOS
-    'FE' : [6], #DOMIGOS O FESTIVOS
-}
+#Mean trip times between stops
+trip_profiles = load_trip_profiles()
 
 #FUNCTIONS
 def process_day_df(line_df,date) :
@@ -67,8 +51,7 @@ def process_day_df(line_df,date) :
         day_type = 'FE'
 
     #Stops of each line reversed
-    stops1 = lines_collected_dict[line]['1']['stops'][-2::-1][0:-2]
-    stops2 = lines_collected_dict[line]['2']['stops'][-2::-1][0:-2]
+    stops1,stops2 = headway_stops(line)
 
     #Assign destination values
     dest2,dest1 = lines_collected_dict[line]['destinations']
@@ -80,26 +63,28 @@ def process_day_df(line_df,date) :
 
     rows_list = []
     if day_df.shape[0] > 0 :
-        #First interval for the iteration :
-        actual_date = day_df.iloc[0].datetime
-        start_interval = actual_date - timedelta(seconds=10)
-        end_interval = actual_date + timedelta(seconds=30)
+        #Start of every burst, the first row more than 30 seconds after the start of the previous one
+        times = day_df.datetime.values
+        starts = [0]
+        while True :
+            next_start = np.searchsorted(times, times[starts[-1]] + np.timedelta64(30,'s'), side='right')
+            if next_start >= len(times) :
+                break
+            starts.append(next_start)
+        #Rows of every burst, from 10 seconds before its start to 30 seconds after it
+        firsts = np.searchsorted(times, times[starts] - np.timedelta64(10,'s'), side='right')
+        lasts = np.searchsorted(times, times[starts] + np.timedelta64(30,'s'), side='left')
 
         #Iterate over bursts
         last_hour = -10
-        while True :
-            int_df = day_df.loc[(day_df.datetime > start_interval) & (day_df.datetime < end_interval)]
+        for start,first,last in zip(starts,firsts,lasts) :
+            actual_date = day_df.datetime.iloc[start]
+            int_df = day_df.iloc[first:last]
 
             if actual_date.hour > last_hour :
                 last_hour = actual_date.hour
-                #Process mean times between stops
-                tims_bt_stops = times_bt_stops.loc[(times_bt_stops.line == line) & \
-                                                    (times_bt_stops.date.dt.weekday.isin(day_type_dict[day_type])) & \
-                                                    (times_bt_stops.st_hour >= last_hour) & \
-                                                    (times_bt_stops.st_hour < last_hour+1)]
-                #Group and get the mean values
-                tims_bt_stops = tims_bt_stops.groupby(['line','direction','stopA','stopB']).mean()
-                tims_bt_stops = tims_bt_stops.reset_index()[['line','direction','stopA','stopB','trip_time','api_trip_time']]
+                #Mean times from the stops to the first one
+                times_to_stops = trip_profiles.times_to_stops(line,day_type,[last_hour,last_hour+1])
 
             if int_df.shape[0] > 0 :
                 #All stops of the line
@@ -107,20 +92,11 @@ def process_day_df(line_df,date) :
                 stop_df_list = []
                 buses_out1,buses_out2 = [],[]
                 dest,direction = dest1,1
-                for i in range(len(stops)) :
+                for i in range(len(times_to_stops)) :
                     stop = stops[i]
-                    if i == 0 :
-                        mean_time_to_stop = 0
-                    elif i == len(stops1) :
-                        mean_time_to_stop = 0
+                    mean_time_to_stop = times_to_stops[i]
+                    if i == len(stops1) :
                         dest,direction = dest2,2
-                    else :
-                        mean_df = tims_bt_stops.loc[(tims_bt_stops.stopA == int(stop)) & \
-                                        (tims_bt_stops.direction == direction)]
-                        if mean_df.shape[0] > 0 :
-                            mean_time_to_stop += mean_df.iloc[0].trip_time
-                        else :
-                            break
 
                     stop_df = int_df.loc[(int_df.stop == int(stop)) & \
                                         (int_df.destination == dest)]
@@ -149,7 +125,7 @@ def process_day_df(line_df,date) :
                     stops_df = pd.concat(stop_df_list)
 
                     #Group by bus and destination
-                    stops_df = stops_df.groupby(['bus','destination']).mean()
+                    stops_df = stops_df.groupby(['bus','destination'],observed=True).mean()
                     stops_df = stops_df.reset_index().drop_duplicates('bus',keep='first')
                     #Loc buses not given by first stop
                     stops_df = stops_df.loc[((stops_df.destination == dest1) & (~stops_df.bus.isin(buses_out1))) | \
@@ -304,19 +280,6 @@ def process_day_df(line_df,date) :
                                 else :
                                     hw_pos2 += 1
 
-            #Update iteration interval
-            next_df = day_df.loc[(day_df.datetime > end_interval) & \
-                                    (day_df.datetime < end_interval + timedelta(minutes=5))]
-            if next_df.shape[0] == 0 :
-                next_df = day_df.loc[(day_df.datetime > end_interval)]
-
-            if next_df.shape[0] != 0 :
-                actual_date = next_df.iloc[0].datetime
-                start_interval = actual_date - timedelta(seconds=10)
-                end_interval = actual_date + timedelta(seconds=30)
-            else :
-                break
-
     return pd.DataFrame(rows_list)
 
 def get_headways(df) :
@@ -340,44 +303,29 @@ def get_headways(df) :
         dfs_list += dfs
 
     #Concatenate dataframes
-    processed_df = pd.concat(dfs_list).sort_values(by=['line','datetime','direction'], ascending=True).reset_index(drop = True)
+    processed_df = pd.concat(dfs_list)
+    if processed_df.shape[0] == 0 :
+        return processed_df
+    processed_df = processed_df.sort_values(by=['line','datetime','direction'], ascending=True).reset_index(drop = True)
     return processed_df
 
 #MAIN
 
 def main():
-    # WE LOAD THE ARRIVAL TIMES DATA
+    # WE LOAD THE ARRIVAL TIMES DATA AND PROCESS IT ONE DAY AT A TIME
     now = datetime.datetime.now()
     print('\n-------------------------------------------------------------------')
-    print('Reading the data cleaned with the arrival times included... - {}\n'.format(now))
-    buses_data = pd.read_csv('../../Data/Processed/buses_data_pc.csv',
-        dtype={
-            'line': 'str',
-            'destination': 'str',
-            'stop': 'uint16',
-            'bus': 'uint16',
-            'given_coords': 'bool',
-            'pos_in_burst':'uint16',
-            'estimateArrive': 'int32',
-            'DistanceBus': 'int32',
-            'request_time': 'int32',
-            'lat':'float32',
-            'lon':'float32'
-        }
-    )[['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']]
-
-    #Parse the dates
-    buses_data['datetime'] = pd.to_datetime(buses_data['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
-    print(buses_data.info())
-    lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-    print('\nFinished in {} seconds'.format(lapsed_seconds))
-    print('-------------------------------------------------------------------\n\n')
-
-    #Preprocess data; adds day_trip, arrival_time and calculated coordinates attributes
-    now = datetime.datetime.now()
-    print('-------------------------------------------------------------------')
-    print('Processing headways between buses... - {}\n'.format(now))
-    headways = get_headways(buses_data)
+    print('Processing headways between buses day by day... - {}\n'.format(now))
+    days = read_csv_days('../../Data/Processed/buses_data_pc.csv',
+        columns=['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']
+    )
+    dfs_list = []
+    for day,buses_data in days :
+        dfs_list.append(get_headways(buses_data))
+        print('{} - {} rows read, {} headways'.format(day,buses_data.shape[0],dfs_list[-1].shape[0]))
+    headways = pd.concat(dfs_list)
+    if headways.shape[0] > 0 :
+        headways = headways.sort_values(by=['line','datetime','direction'], ascending=True).reset_index(drop = True)
     print(headways.info())
     lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
     print('\nFinished in {} seconds'.format(lapsed_seconds))
@@ -1,16 +1,20 @@
 import pandas as pd
 import json
 
+import os
+import sys
 import datetime
 from datetime import timedelta
 
 from sys import argv
 
-from pandarallel import pandarallel
-from joblib import Parallel, delayed
-import multiprocessing
-num_cores = multiprocessing.cpu_count()
-pandarallel.initialize()
+import numpy as np
+import pyarrow as pa
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Common'))
+from cleaning import clean_data, line_dest_index, line_dest_valid_stops, max_stop
+from day_chunks import read_csv_days_from
+from bus_schema import to_schema
 
 # WE LOAD THE STOPS AND LINES DATA
 lines_shapes = pd.read_csv('../../Data/Static/lines_shapes.csv')
@@ -65,52 +69,6 @@ def find_nearest_row_by_dist(df,dist_traveled) :
     return nearest_row
 
 
-def process_bus_df(bus,df_stop,threshold,line_shape):
-    '''
-    Processes the rows adding day_trip, arrival time and calculated coordinates attributes
-    '''
-    df_bus = df_stop.loc[df_stop.bus == bus].sort_values(by='datetime').reset_index(drop=True)
-    stop_id = df_bus.iloc[0].stop
-    last_index = 0
-    last_time = df_bus.iloc[0].datetime
-    day_trip = 0
-    trips,calc_lats,calc_lons = [],[],[]
-    for i in range(df_bus.shape[0]) :
-        #Calculate coordinates
-        #calc_lon,calc_lat = calculate_coords(line_shape,stop_id,df_bus.iloc[i]['DistanceBus'])
-        #calc_lons.append(calc_lon)
-        #calc_lats.append(calc_lat)
-
-        #Estimate arrival time for each slice
-        if ((df_bus.iloc[i].datetime - last_time).total_seconds() > 600) | (i==df_bus.shape[0]-1) :
-            #Trip dataframe
-            df_trip = df_bus.iloc[last_index:i]
-
-            if df_trip.shape[0] != 0 :
-                #Trip number inside the day
-                day_trip += 1
-
-                #Get first row with estimateArrive < threshold seconds
-                df_close = df_trip.loc[df_trip.estimateArrive<threshold]
-                if df_close.shape[0] != 0 :
-                    row = df_close.sort_values(by='datetime',ascending='True').iloc[0]
-                else :
-                    row = df_trip.loc[df_trip.estimateArrive==df_trip.estimateArrive.min()].iloc[0]
-
-                #Assign arrival time and trip day
-                df_trip = df_trip.assign(
-                    day_trip=day_trip,
-                    arrival_time=row.datetime + timedelta(seconds=int(row.estimateArrive)),
-                    #calc_lat=calc_lats[last_index:i],
-                    #calc_lon=calc_lons[last_index:i]
-                )
-                trips.append(df_trip)
-                last_index = i
-        #Update last time value
-        last_time = df_bus.iloc[i].datetime
-    return trips
-
-
 def add_arrival_time_estim(df,threshold) :
     '''
     Returns the dataframe with a new column with the estimation of the time when the bus has arrived the stop
@@ -118,96 +76,147 @@ def add_arrival_time_estim(df,threshold) :
     is based on the value of ''estimateArrive'' for the first row that is less than threshold
     seconds away from the stop.
 
-    May take a long time for big dataframes
-
     Parameters
     ----------------------
     df : The dataframe where we wish to add the column
 
     '''
-    #Get number of days lapsed
-    days = (df.datetime.max()-df.datetime.min()).days + 1
-    first_date = df.datetime.min()
-    #List to add the trip dataframes
-    trips = []
-    for day in range(days) :
-        df_day = df.loc[df.datetime.dt.date == (first_date+timedelta(days=day))]
-        #For each line of the bus.
-        lines = df_day.line.unique().tolist()
-        for line in lines :
-            df_line = df_day.loc[df_day.line == line]
-            #For each destination in that line
-            for dest in lines_collected_dict[line]['destinations'] :
-                direction = '1' if dest == lines_collected_dict[line]['destinations'][1] else '2'
-                line_shape = lines_shapes.loc[(lines_shapes.line_sn == line)&(lines_shapes.direction == int(direction))]
-                df_dest = df_line.loc[df.destination == dest]
-                #For each stop in that line and destination
-                for stop in lines_collected_dict[line][direction]['stops'] :
-                    df_stop = df_dest.loc[df_dest.stop == int(stop)]
-                    #For each bus in that line destination and stop
-                    buses = df_stop.bus.unique().tolist()
-                    trips += sum((Parallel(n_jobs=num_cores)(delayed(process_bus_df)(bus,df_stop,threshold,line_shape) for bus in buses)), [])
-    new_df = pd.concat(trips).sort_values(by='datetime',ascending='True')
+    #Only the stops of the line in the direction of the destination
+    pos = line_dest_index.get_indexer(pd.MultiIndex.from_arrays([df.line.astype(str).values,df.destination.astype(str).values]))
+    stop = df.stop.values.astype('int64')
+    valid = (pos >= 0) & (stop <= max_stop)
+    valid[valid] = line_dest_valid_stops[pos[valid],stop[valid]]
+
+    #Rows of every bus at every stop one after the other, in time order
+    df = df.loc[valid].sort_values(by=['line','destination','stop','bus','datetime'],kind='mergesort').reset_index(drop=True)
+    if df.shape[0] == 0 :
+        return df.assign(day_trip=[],arrival_time=pd.Series([],dtype='datetime64[ns]'))[
+            ['line','destination','stop','bus','day_trip','datetime','estimateArrive','DistanceBus','arrival_time','given_coords','lat','lon']]
+    day = df.datetime.dt.normalize()
+
+    #A bus starts a new series of rows at every stop and day, and a new trip after a gap of more than 10 minutes
+    new_group = (df.line != df.line.shift()) | (df.destination != df.destination.shift()) | \
+                (df.stop != df.stop.shift()) | (df.bus != df.bus.shift()) | (day != day.shift())
+    new_trip = new_group | (df.datetime.diff().dt.total_seconds() > 600)
+    group = new_group.cumsum().values
+    trip = new_trip.cumsum().values
+
+    #The last row of every series is left out of its trip, like it has always been
+    last_of_group = np.append(group[1:] != group[:-1], True)
+    df,group,trip = df.loc[~last_of_group].reset_index(drop=True),group[~last_of_group],trip[~last_of_group]
+
+    #Trip number inside the day
+    first_trip = pd.Series(trip).groupby(group).transform('min').values
+    df['day_trip'] = trip - first_trip + 1
+
+    #Row of every trip whose estimation gives the arrival time: the first one with
+    #estimateArrive < threshold seconds, or the first one with the minimum estimateArrive
+    positions = pd.Series(np.arange(df.shape[0]))
+    close = (df.estimateArrive < threshold).values
+    first_close = positions[close].groupby(trip[close]).first()
+    first_min = df.estimateArrive.groupby(trip).idxmin()
+    arrival_row = first_close.reindex(first_min.index).fillna(first_min).astype('int64')
+
+    #Assign arrival time
+    arrival_time = df.datetime.values[arrival_row.values] + \
+                   pd.to_timedelta(df.estimateArrive.values[arrival_row.values].astype('int64'),unit='s').values
+    df['arrival_time'] = pd.Series(arrival_time,index=arrival_row.index).reindex(trip).values
+
+    new_df = df.sort_values(by='datetime',ascending=True,kind='mergesort').reset_index(drop=True)
     return new_df[['line','destination','stop','bus','day_trip','datetime','estimateArrive','DistanceBus','arrival_time','given_coords','lat','lon']]
 
 
-def clean_data(df,preprocess) :
+def iter_raw_days(skip_days=None, csv_offset=0) :
     '''
-    Returns the dataframe without the rows that dont match the conditions specified
+    Yields the raw data collected one day at a time, as ('YYYY-MM-DD', DataFrame,
+    offset) tuples, from the csv file and from the day partitioned Arrow files
+    written by the collector, whichever exist. The offset is the one in bytes of
+    the end of the day in the csv file, None for the days only in Arrow files
 
     Parameters
     ----------------
-    df : DataFrame
-        Dataframe to clean
-    processed : bool
-        Boolean that indicates if the data has been processed
+    skip_days : set
+        Days, as 'YYYY-MM-DD' strings, that are left out
+    csv_offset : int
+        Offset in bytes of the csv file where the rows not processed yet start
     '''
-    def check_conditions(row) :
-        '''
-        Checks if every row in the dataframe matchs the conditions
+    skip_days = skip_days if skip_days != None else set()
+    columns = ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus','given_coords','lat','lon']
+
+    #Day directories of the Arrow files
+    d = '../../Data/Raw/buses_data/'
+    arrow_days = {}
+    if os.path.isdir(d) :
+        for day_dir in sorted(os.listdir(d)) :
+            day = day_dir.replace('date=','')
+            if day not in skip_days :
+                arrow_days[day] = os.path.join(d,day_dir)
+
+    def read_arrow_day(day_dir) :
+        tables = []
+        for part in sorted(os.listdir(day_dir)) :
+            #Typed columns, memory mapped instead of parsed
+            with pa.memory_map(os.path.join(day_dir,part)) as source :
+                table = pa.ipc.open_stream(source).read_all()
+                tables.append(pa.Table.from_arrays([table.column(column) for column in columns], names=columns))
+        return to_schema(pa.concat_tables(tables).to_pandas())
+
+    f = '../../Data/Raw/buses_data.csv'
+    if os.path.isfile(f) :
+        #A raw file smaller than the offset is not the one processed before, it is read again
+        if os.path.getsize(f) < csv_offset :
+            csv_offset = 0
+        csv_days = read_csv_days_from(f,csv_offset,
+            columns=columns,
+            skip_days=skip_days
+        )
+        for day,day_df,day_end in csv_days :
+            #The day the output format was changed has data in both
+            if day in arrow_days :
+                day_df = pd.concat([day_df,read_arrow_day(arrow_days.pop(day))],ignore_index=True)
+            yield day,day_df,day_end
+
+    for day in sorted(arrow_days.keys()) :
+        yield day,read_arrow_day(arrow_days[day]),None
+
+
+def read_manifest(f) :
+    '''
+    Returns the manifest of the processed data file, with the days it
+    contains, its size in bytes after they were appended and the offset in
+    bytes of the raw csv file after them, or None if the file was not built
+    incrementally
+
+    Parameters
+    ----------------
+    f : str
+        Path of the manifest
+    '''
+    if not os.path.isfile(f) :
+        return None
+    with open(f, 'r') as f_manifest :
+        return json.load(f_manifest)
 
-        Parameters
-        ----------------
-        row : DataFrame
-            Dataframe to clean
-        processed : bool
-            Boolean that indicates if the data has been processed
-        '''
-        #Direction
-        direction = '1' if row.destination == lines_collected_dict[row.line]['destinations'][1] else '2'
-
-        #Line destination stop coherence condition
-        line_dest_stop_cond = False
-        if row.line in lines_collected_dict.keys() :
-            if row.destination in lines_collected_dict[row.line]['destinations'] :
-                if str(row.stop) in lines_collected_dict[row.line][direction]['stops'] :
-                    line_dest_stop_cond = True
-
-        # DistanceBus values lower than the line length or negative
-        dist_cond = (row.DistanceBus >= 0) and \
-                    (row.DistanceBus < int(lines_collected_dict[row.line][direction]['length']))
-
-        # estimateArrive values lower than the time it takes to go through the line at an speed
-        # of 2m/s, instantaneous speed lower than 120 km/h and positive values and time remaining lower than 2 hours
-        eta_cond = (row.estimateArrive > 0) and \
-                   (row.estimateArrive < (int(lines_collected_dict[row.line][direction]['length'])/2)) and \
-                   ((3.6*row.DistanceBus/row.estimateArrive) < 120) & \
-                   (row.estimateArrive < 7200)
-
-        return line_dest_stop_cond and dist_cond and eta_cond
-
-    #Check conditions in df
-    mask = df.parallel_apply(check_conditions,axis=1)
-    #Select rows that match the conditions
-    df = df.loc[mask].reset_index(drop=True)
-    #Return cleaned DataFrame
-    return df
 
+def write_manifest(f,manifest) :
+    '''
+    Writes the manifest atomically, renaming a temporary file
+
+    Parameters
+    ----------------
+    f : str
+        Path of the manifest
+    manifest : dict
+        Days processed, size of the processed data file and offset of the raw one
+    '''
+    with open(f+'.tmp', 'w') as f_manifest :
+        json.dump(manifest, f_manifest)
+    os.replace(f+'.tmp',f)
 
 
 def main():
     #Read passed parameters
-    preprocess,clean = False,False
+    preprocess,clean,incremental = False,False,False
     f = '../../Data/Processed/buses_data_'
     if len(argv)>1:
         if ('p' in argv[1]) :
@@ -216,73 +225,77 @@ def main():
         if ('c' in argv[1]) :
             clean = True
             f = f + 'c'
+        if ('i' in argv[1]) :
+            incremental = True
         if not (clean or preprocess) :
-            print('Arguments passed not valid; use -p for preprocess, -p for clean or -pc for both.\n')
+            print('Arguments passed not valid; use -p for preprocess, -p for clean or -pc for both, adding i to process only the new days.\n')
             exit(0)
     else :
-        print('Arguments passed not valid; use -p for preprocess, -p for clean or -pc for both.\n')
+        print('Arguments passed not valid; use -p for preprocess, -p for clean or -pc for both, adding i to process only the new days.\n')
         exit(0)
+    f_manifest = f + '.json'
     f = f + '.csv'
 
-    # WE LOAD THE ARRIVAL TIMES DATA
-    now = datetime.datetime.now()
+    #Days already in the processed data. Without a manifest the incremental mode rebuilds the file
+    manifest = read_manifest(f_manifest) if incremental else None
+    if (manifest != None) and (not os.path.isfile(f)) :
+        manifest = None
+    done_days = set(manifest['days']) if manifest != None else set()
+    #Offset of the raw csv file after the last day processed, the rows before it are not read again
+    raw_offset = manifest.get('raw_offset',0) if manifest != None else 0
+
+    #Leave out anything appended after the last manifest, it belongs to a run that did not finish
+    if manifest != None :
+        if os.path.getsize(f) > manifest['size'] :
+            os.truncate(f,manifest['size'])
+    else :
+        #The file is rebuilt with all the days
+        if os.path.isfile(f) :
+            os.remove(f)
+        if os.path.isfile(f_manifest) :
+            os.remove(f_manifest)
+
+    #Read, process and write the data one day at a time, so only a day of data is in memory
+    start = datetime.datetime.now()
     print('\n-------------------------------------------------------------------')
-    print('Reading the original data... - {}\n'.format(now))
-    buses_data = pd.read_csv('../../Data/Raw/buses_data.csv',
-        dtype={
-            'line': 'str',
-            'destination': 'str',
-            'stop': 'uint16',
-            'bus': 'uint16',
-            'given_coords': 'bool',
-            'pos_in_burst':'uint16',
-            'estimateArrive': 'int32',
-            'DistanceBus': 'int32',
-            'request_time': 'int32',
-            'lat':'float32',
-            'lon':'float32'
-        }
-    )[['line','destination','stop','bus','datetime','estimateArrive','DistanceBus','given_coords','lat','lon']]
-
-    #Parse the dates
-    buses_data['datetime'] = pd.to_datetime(buses_data['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
-    print(buses_data.info())
-    lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-    print('\nFinished in {} seconds'.format(lapsed_seconds))
-    print('-------------------------------------------------------------------\n\n')
-
-    #Preprocess data; adds day_trip, arrival_time and calculated coordinates attributes
-    if preprocess :
+    print('Processing the data day by day, writing it to {}... - {}\n'.format(f,start))
+    n_days = 0
+    for day,buses_data,day_end in iter_raw_days(done_days,raw_offset) :
+        #In the incremental mode only the days that are complete, the collector is still writing today
+        if incremental and (day >= datetime.date.today().isoformat()) :
+            continue
         now = datetime.datetime.now()
-        print('-------------------------------------------------------------------')
-        print('Preprocessing the data... - {}\n'.format(now))
-        buses_data = add_arrival_time_estim(buses_data,45)
-        print(buses_data.info())
-        lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-        print('\nFinished in {} seconds'.format(lapsed_seconds))
-        print('-------------------------------------------------------------------\n\n')
+        n_raw = buses_data.shape[0]
+
+        #Preprocess data; adds day_trip, arrival_time and calculated coordinates attributes
+        if preprocess :
+            buses_data = add_arrival_time_estim(buses_data,45)
+
+        #Clean the data
+        if clean :
+            buses_data = clean_data(buses_data)
+
+        #Append the day to the file, with the same date format every day
+        header = (not os.path.isfile(f)) or (os.path.getsize(f) == 0)
+        buses_data.to_csv(f, mode='a', header=header, date_format='%Y-%m-%d %H:%M:%S.%f')
+        if incremental :
+            done_days.add(day)
+            if day_end != None :
+                raw_offset = day_end
+            write_manifest(f_manifest,{
+                'days': sorted(done_days),
+                'size': os.path.getsize(f),
+                'raw_offset': raw_offset
+            })
+        n_days += 1
 
-
-    #Clean the data
-    if clean :
-        now = datetime.datetime.now()
-        print('-------------------------------------------------------------------')
-        print('Cleaning the data... - {}\n'.format(now))
-        buses_data = clean_data(buses_data,preprocess)
-        print(buses_data.info())
         lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-        print('\nFinished in {} seconds'.format(lapsed_seconds))
-        print('-------------------------------------------------------------------\n\n')
-
-
-    #Processed data info
-    now = datetime.datetime.now()
-    print('-------------------------------------------------------------------')
-    print('Writting new data to {}... - {}'.format(f,now))
-    #Write result to file
-    buses_data.to_csv(f)
-    lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-    print('\nFinished in {} seconds'.format(lapsed_seconds))
+        print('{} - {} rows read, {} rows written in {} seconds'.format(day,n_raw,buses_data.shape[0],lapsed_seconds))
+
+    if n_days == 0 :
+        print('There are no new days to process')
+    lapsed_seconds = round((datetime.datetime.now()-start).total_seconds(),3)
+    print('\n{} days processed in {} seconds'.format(n_days,lapsed_seconds))
     print('-------------------------------------------------------------------\n\n')
 
     print('New data is ready!\n')
@@ -1,14 +1,17 @@
 import pandas as pd
+import numpy as np
 import json
 
+import os
+import sys
 import datetime
 from datetime import timedelta
 
 from sys import argv
 
-from joblib import Parallel, delayed
-import multiprocessing
-num_cores = multiprocessing.cpu_count()
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Common'))
+from day_chunks import read_csv_days
+from bus_schema import to_schema
 
 
 #Load line_stops_dict
@@ -16,171 +19,146 @@ with open('../../Data/Static/lines_collected_dict.json', 'r') as f:
     lines_collected_dict = json.load(f)
 
 #FUNCTIONS
-def process_hour_df(line_df,hour) :
+def get_segments_df() :
     '''
-    Returns the dataframe with the times between stops for the line and hour selected.
+    Returns a dataframe with the stops of every segment between consecutive stops of the
+    lines, with role 0 for the first stop of the segment and 1 for the second. The rows that
+    give the second stop of the last segment are the ones with the destination of the
+    opposite direction, the buses give the estimations of their next trip when they reach it
+    '''
+    rows = []
+    for line in lines_collected_dict.keys() :
+        dest2,dest1 = lines_collected_dict[line]['destinations']
+        for destination in [dest1,dest2] :
+            #Direction and destination values
+            direction = '1' if destination == dest1 else '2'
+            final_dest = dest2 if direction == '1' else dest1
+
+            #Destination stops
+            stops_dir = [int(stop) for stop in lines_collected_dict[line][direction]['stops']]
+            for i in range(len(stops_dir)-1) :
+                stop_dest = final_dest if i == len(stops_dir)-2 else destination
+                rows.append((line,destination,stops_dir[i],direction,i,stops_dir[i],stops_dir[i+1],0))
+                rows.append((line,stop_dest,stops_dir[i+1],direction,i,stops_dir[i],stops_dir[i+1],1))
+
+    segments_df = pd.DataFrame(rows, columns=['line','destination','stop','direction','segment','stopA','stopB','role'])
+    return to_schema(segments_df)
+
+#Segments of every line and direction
+segments_df = get_segments_df()
+
+
+def first_estimations(df,groups,times) :
+    '''
+    Returns the estimateArrive of the first row of the dataframe of every group in the minute
+    before the time given, or nan if there is none. The rows are looked up with an as-of join
 
     Parameters
     -----------------
-        line_df: Dataframe
-        hour : int
+        df: Dataframe
+            Rows with their group, in time order
+        groups : array
+            Groups to look up
+        times : array
+            Times to look up
     '''
-    #Hour df
-    hour_df = line_df.loc[line_df.datetime.dt.hour == hour]
-    if hour_df.shape[0] == 0 :
-        return pd.DataFrame([])
-    #Line id
-    line = hour_df.iloc[0].line
-
-    start_date = hour_df.datetime.min()
-    end_date = hour_df.datetime.max()
-    date = start_date
-
-    #Rows list to build
-    rows_list = []
-
-    #Iterate over dates
-    while date < end_date :
-        date_hour_df = hour_df.loc[(hour_df.datetime.dt.year == date.year) & \
-                                (hour_df.datetime.dt.month == date.month) & \
-                                (hour_df.datetime.dt.day == date.day)]
-        #Update date value for next iteration
-        date = date + timedelta(days=1)
-
-        if date_hour_df.shape[0] > 0 :
-            #Iterate over destinations
-            dest2,dest1 = lines_collected_dict[line]['destinations']
-            for destination in [dest1,dest2] :
-                #Direction and destination values
-                direction = '1' if destination == dest1 else '2'
-                final_dest = dest2 if direction == '1' else dest1
-
-                #Destination stops
-                stops_dir = lines_collected_dict[line][direction]['stops']
-
-                #Destination and final stop dfs
-                dest_df = date_hour_df.loc[date_hour_df.destination == destination]
-                final_stop_df = date_hour_df.loc[(date_hour_df.stop == int(stops_dir[-1])) & \
-                                                  (date_hour_df.destination == final_dest)]
-
-                #Iterate over stops
-                for i in range(len(stops_dir)-1):
-                    #Stops to analyse
-                    stop1 = int(stops_dir[i])
-                    stop2 = int(stops_dir[i+1])
-
-                    #Data for these 2 stops
-                    if i == len(stops_dir)-2 :
-                        stops_df_all = dest_df.loc[dest_df.stop==stop1]
-                        stops_df_all = pd.concat([stops_df_all,final_stop_df])
-                    else :
-                        stops_df_all = dest_df.loc[dest_df.stop.isin([stop1,stop2])]
-
-                    #Data ordered and without duplicates
-                    stops_df = stops_df_all.drop_duplicates(subset=['bus','stop','arrival_time'],keep='first')
-                    stops_df = stops_df.sort_values(by=['bus','arrival_time'],ascending=True)
-
-                    times_between_stops = []
-                    api_times_bt_stops = []
-
-                    n = 0
-                    while n < (stops_df.shape[0]-1) :
-                        first_stop = stops_df.iloc[n]
-                        second_stop = stops_df.iloc[n+1]
-                        if (first_stop.stop == stop1) and (second_stop.stop == stop2) and (first_stop.bus == second_stop.bus) :
-                            #We create the row dictionary
-                            row = {}
-                            row['date'] = first_stop.datetime.strftime('%Y-%m-%d')
-                            row['line'] = line
-                            row['direction'] = direction
-                            row['st_hour'] = hour
-                            row['end_hour'] = hour+1
-                            row['stopA'] = first_stop.stop
-                            row['stopB'] = second_stop.stop
-                            row['bus'] = first_stop.bus
-                            #Time to next stop
-                            time_between_stops = (second_stop.arrival_time-first_stop.arrival_time).total_seconds()
-
-
-                            #API time to next stop
-                            api_estim = stops_df_all.loc[(stops_df_all.datetime > (first_stop.arrival_time - timedelta(seconds = 60))) & \
-                                                        (stops_df_all.datetime < (first_stop.arrival_time)) & \
-                                                        (stops_df_all.bus == second_stop.bus)]
-
-                            if api_estim.shape[0] > 1 :
-                                estim_act = api_estim.loc[api_estim.stop==first_stop.stop].estimateArrive
-                                estim_next = api_estim.loc[api_estim.stop==second_stop.stop].estimateArrive
-                                if (estim_act.shape[0] > 0) & (estim_next.shape[0] > 0) and (time_between_stops < 600) and (time_between_stops > 0) :
-                                    row['trip_time'] = round(time_between_stops,3)
-                                    row['api_trip_time'] = estim_next.iloc[0]-estim_act.iloc[0]
-                                    rows_list.append(row)
-                            n += 2
-
-                        else :
-                            n += 1
-
-    return pd.DataFrame(rows_list)
+    left = pd.DataFrame({
+        'group': groups,
+        'start': times - np.timedelta64(60,'s'),
+        'end': times,
+        'pos': np.arange(len(groups))
+    }).sort_values(by='start',kind='mergesort')
+    right = df[['group','datetime','estimateArrive']].sort_values(by='datetime',kind='mergesort')
+    #First row of the group after the start of the minute
+    merged = pd.merge_asof(left,right,left_on='start',right_on='datetime',by='group',
+                           direction='forward',allow_exact_matches=False)
+    estims = merged.estimateArrive.where(merged.datetime < merged.end).values.astype('float64')
+    return estims[np.argsort(merged.pos.values)]
+
 
 def get_time_between_stops(df) :
     '''
     Returns a dataframe with the times between stops for every day, line and hour range.
+    The rows of every stop are repeated for each segment of the line they belong to, and the
+    segments of every line, direction, day and hour are sorted and swept at once
 
     Parameters
     -----------------
         df: Dataframe
             Data to process
     '''
-    #For every line collected
-    lines = ['1','44','82','F','G','U','132','133','N2','N6']
-
-    #Get new dictionaries and process the lines
-    dfs_list = []
-    for line in lines :
-        hours = range(0,6) if line in ['N2','N6'] else range(7,23)
-        line_df = df.loc[df.line == line]
-        dfs = (Parallel(n_jobs=num_cores,max_nbytes=None)(delayed(process_hour_df)(line_df,hour) for hour in hours))
-        dfs_list += dfs
-
-    #Concatenate dataframes
-    processed_df = pd.concat(dfs_list).sort_values(by=['line','direction','date','st_hour'], ascending=True).reset_index(drop = True)
+    #Day and hour keys of the rows, the night lines only from 0 to 6 and the rest from 7 to 23
+    df = to_schema(df[['line','destination','stop','bus','datetime','estimateArrive','arrival_time']])
+    hour = df.datetime.dt.hour
+    night = df.line.isin(['N2','N6']).values
+    df = df.loc[np.where(night, hour < 6, (hour >= 7) & (hour < 23))]
+    df = df.assign(day=df.datetime.dt.normalize(), hour=df.datetime.dt.hour, pos=np.arange(df.shape[0]))
+
+    #Rows of every segment, and their group of line, direction, day, hour, segment, stop and bus
+    seg_df = df.merge(segments_df, on=['line','destination','stop'])
+    seg_df['group'] = seg_df.groupby(['line','direction','day','hour','segment','role','bus'],observed=True,sort=False).ngroup()
+
+    #Rows of every bus in the segment ordered and without duplicates
+    seg_df = seg_df.sort_values(by=['line','direction','day','hour','segment','bus','arrival_time','pos'],kind='mergesort')
+    stops_df = seg_df.drop_duplicates(subset=['group','arrival_time'],keep='first')
+
+    #Rows of a bus in the first stop followed by its row in the second stop of the same segment
+    role = stops_df.role.values
+    same_segment = (stops_df.segment.values[:-1] == stops_df.segment.values[1:]) & \
+               (stops_df.bus.values[:-1] == stops_df.bus.values[1:]) & \
+               (stops_df.hour.values[:-1] == stops_df.hour.values[1:]) & \
+               (stops_df.day.values[:-1] == stops_df.day.values[1:]) & \
+               (stops_df.direction.values[:-1] == stops_df.direction.values[1:]) & \
+               (stops_df.line.cat.codes.values[:-1] == stops_df.line.cat.codes.values[1:])
+    is_pair = same_segment & (role[:-1] == 0) & (role[1:] == 1)
+    first_stop = stops_df.iloc[:-1].loc[is_pair]
+    second_stop = stops_df.iloc[1:].loc[is_pair]
+
+    #Time to next stop
+    times_between_stops = (second_stop.arrival_time.values - first_stop.arrival_time.values) / np.timedelta64(1,'s')
+
+    #API estimations of both stops in the minute before the bus arrived the first one
+    estim_act = first_estimations(seg_df,first_stop.group.values,first_stop.arrival_time.values)
+    estim_next = first_estimations(seg_df,second_stop.group.values,first_stop.arrival_time.values)
+
+    valid = (~np.isnan(estim_act)) & (~np.isnan(estim_next)) & \
+            (times_between_stops < 600) & (times_between_stops > 0)
+    first_stop = first_stop.loc[valid]
+    processed_df = pd.DataFrame({
+        'date': first_stop.day.dt.strftime('%Y-%m-%d').values,
+        'line': first_stop.line.astype(str).values,
+        'direction': first_stop.direction.values,
+        'st_hour': first_stop.hour.values,
+        'end_hour': first_stop.hour.values+1,
+        'stopA': first_stop.stopA.values,
+        'stopB': first_stop.stopB.values,
+        'bus': first_stop.bus.values.astype('int64'),
+        'trip_time': [round(time_between_stops,3) for time_between_stops in times_between_stops[valid].tolist()],
+        'api_trip_time': (estim_next[valid]-estim_act[valid]).astype('int64')
+    })
+    if processed_df.shape[0] == 0 :
+        return processed_df
+    processed_df = processed_df.sort_values(by=['line','direction','date','st_hour'], ascending=True).reset_index(drop = True)
     return processed_df
 
 #MAIN
 
 def main():
-    # WE LOAD THE ARRIVAL TIMES DATA
+    # WE LOAD THE ARRIVAL TIMES DATA AND PROCESS IT ONE DAY AT A TIME
     now = datetime.datetime.now()
     print('\n-------------------------------------------------------------------')
-    print('Reading the data cleaned with the arrival times included... - {}\n'.format(now))
-    buses_data = pd.read_csv('../../Data/Processed/buses_data_pc.csv',
-        dtype={
-            'line': 'str',
-            'destination': 'str',
-            'stop': 'uint16',
-            'bus': 'uint16',
-            'given_coords': 'bool',
-            'pos_in_burst':'uint16',
-            'estimateArrive': 'int32',
-            'DistanceBus': 'int32',
-            'request_time': 'int32',
-            'lat':'float32',
-            'lon':'float32'
-        }
-    )[['line','destination','stop','bus','datetime','estimateArrive','arrival_time']]
-
-    #Parse the dates
-    buses_data['datetime'] = pd.to_datetime(buses_data['datetime'], format='%Y-%m-%d %H:%M:%S.%f')
-    buses_data['arrival_time'] = pd.to_datetime(buses_data['arrival_time'], format='%Y-%m-%d %H:%M:%S.%f')
-    print(buses_data.info())
-    lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
-    print('\nFinished in {} seconds'.format(lapsed_seconds))
-    print('-------------------------------------------------------------------\n\n')
-
-    #Preprocess data; adds day_trip, arrival_time and calculated coordinates attributes
-    now = datetime.datetime.now()
-    print('-------------------------------------------------------------------')
-    print('Processing times between stops... - {}\n'.format(now))
-    times_bt_stops = get_time_between_stops(buses_data)
+    print('Processing times between stops day by day... - {}\n'.format(now))
+    days = read_csv_days('../../Data/Processed/buses_data_pc.csv',
+        columns=['line','destination','stop','bus','datetime','estimateArrive','arrival_time'],
+        date_columns=['datetime','arrival_time']
+    )
+    dfs_list = []
+    for day,buses_data in days :
+        dfs_list.append(get_time_between_stops(buses_data))
+        print('{} - {} rows read, {} times between stops'.format(day,buses_data.shape[0],dfs_list[-1].shape[0]))
+    times_bt_stops = pd.concat(dfs_list)
+    if times_bt_stops.shape[0] > 0 :
+        times_bt_stops = times_bt_stops.sort_values(by=['line','direction','date','st_hour'], ascending=True).reset_index(drop = True)
     print(times_bt_stops.info())
     lapsed_seconds = round((datetime.datetime.now()-now).total_seconds(),3)
     print('\nFinished in {} seconds'.format(lapsed_seconds))
@@ -0,0 +1,7 @@
+import os
+import sys
+
+#The scripts import their modules from their own directories and Common
+scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Scripts')
+for d in ['Common','CollectData','ProcessData'] :
+    sys.path.append(os.path.join(scripts_dir,d))
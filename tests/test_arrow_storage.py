@@ -0,0 +1,65 @@
+import os
+import shutil
+import importlib
+
+import pandas as pd
+
+from arrow_storage import DayPartitionedWriter
+
+static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','Data','Static')
+
+def raw_df(datetimes) :
+    n = len(datetimes)
+    return pd.DataFrame({
+        'bus': [4002+i for i in range(n)],
+        'line': ['1','44']*(n//2) + ['1']*(n%2),
+        'stop': [10]*n,
+        'datetime': pd.to_datetime(datetimes),
+        'isHead': ['False']*n,
+        'destination': ['CRISTO REY','CALLAO']*(n//2) + ['CRISTO REY']*(n%2),
+        'deviation': [0]*n,
+        'estimateArrive': [100+i for i in range(n)],
+        'DistanceBus': [1000+i for i in range(n)],
+        'request_time': [10]*n,
+        'given_coords': [True]*n,
+        'lat': [40.4]*n,
+        'lon': [-3.7]*n
+    })
+
+
+def test_write_and_read_raw_days(tmp_path, monkeypatch) :
+    #Data directories as seen from the directory of the script
+    (tmp_path/'Scripts'/'ProcessData').mkdir(parents=True)
+    (tmp_path/'Data'/'Static').mkdir(parents=True)
+    shutil.copy(os.path.join(static_dir,'lines_collected_dict.json'),str(tmp_path/'Data'/'Static'))
+    (tmp_path/'Data'/'Static'/'lines_shapes.csv').write_text('line_sn,line_id,direction\n1,1,1\n')
+    raw_dir = tmp_path/'Data'/'Raw'/'buses_data'
+    bursts = [
+        raw_df(['2020-02-03 23:59:50','2020-02-03 23:59:51']),
+        raw_df(['2020-02-03 23:59:58','2020-02-04 00:00:01','2020-02-04 00:00:02'])
+    ]
+    writer = DayPartitionedWriter(str(raw_dir))
+    for burst in bursts :
+        writer.write(burst,fsync=True)
+    writer.close()
+    #A restarted collector writes a new part of the day
+    writer = DayPartitionedWriter(str(raw_dir))
+    writer.write(raw_df(['2020-02-04 00:00:30']))
+    writer.close()
+
+    #The script reads the static data when imported
+    monkeypatch.chdir(tmp_path/'Scripts'/'ProcessData')
+    preprocess_clean = importlib.import_module('preprocess_clean')
+    days = list(preprocess_clean.iter_raw_days())
+    assert [(day,day_df.shape[0],day_end) for day,day_df,day_end in days] == [('2020-02-03',3,None),('2020-02-04',3,None)]
+
+    day_df = days[1][1]
+    assert day_df.columns.tolist() == ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus','given_coords','lat','lon']
+    assert day_df.line.tolist() == ['44','1','1']
+    assert pd.api.types.is_categorical_dtype(day_df.line)
+    assert day_df.stop.dtype == 'uint16'
+    assert day_df.datetime.tolist() == pd.to_datetime(['2020-02-04 00:00:01','2020-02-04 00:00:02','2020-02-04 00:00:30']).tolist()
+    assert day_df.estimateArrive.tolist() == [101,102,100]
+
+    #Days already processed are left out
+    assert [day for day,day_df,day_end in preprocess_clean.iter_raw_days({'2020-02-03'})] == ['2020-02-04']
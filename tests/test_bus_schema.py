@@ -0,0 +1,27 @@
+import pandas as pd
+
+from bus_schema import to_schema, bus_dtypes
+
+
+def test_to_schema_object_columns() :
+    #Like the frames read from feather or Arrow files, with the strings as objects
+    df = pd.DataFrame({
+        'line': ['1','44','not a line'],
+        'destination': ['CRISTO REY','PROSPERIDAD','CRISTO REY'],
+        'stop': [1,2,3],
+        'lat': [40.4,40.5,40.6],
+        'other': ['a','b','c']
+    })
+    df = to_schema(df)
+    assert pd.api.types.is_dtype_equal(df.line.dtype,bus_dtypes['line'])
+    assert pd.api.types.is_dtype_equal(df.destination.dtype,bus_dtypes['destination'])
+    assert df.stop.dtype == 'uint16'
+    assert df.lat.dtype == 'float32'
+    assert df.other.dtype == object
+    assert df.line.tolist()[:2] == ['1','44']
+    assert pd.isnull(df.line.iloc[2])
+
+
+def test_to_schema_keeps_typed_frame() :
+    df = to_schema(pd.DataFrame({'line': ['1'],'stop': [1]}))
+    assert to_schema(df) is df
@@ -0,0 +1,53 @@
+import pandas as pd
+
+from day_chunks import read_csv_days_from, read_csv_days
+
+header = ',bus,line,stop,datetime,isHead,destination,deviation,estimateArrive,DistanceBus,request_time,given_coords,lat,lon\n'
+columns = ['line','destination','stop','bus','datetime','estimateArrive','DistanceBus']
+
+def raw_row(i,datetime) :
+    return '{},4002,1,10,{},False,CRISTO REY,0,{},{},10,True,40.4,-3.7\n'.format(i,datetime,100+i,1000+i)
+
+
+def write_raw(f,rows) :
+    with open(f,'w') as f_raw :
+        f_raw.write(header + ''.join(rows))
+
+
+def test_row_being_written(tmp_path) :
+    #A complete row and the start of the next one, still being appended by the collector
+    f = str(tmp_path/'buses_data.csv')
+    write_raw(f,[raw_row(0,'2020-02-03 07:00:00.000001'),'1,4002,1,10'])
+    days = list(read_csv_days_from(f,0,columns))
+    assert [(day,day_df.shape[0]) for day,day_df,end in days] == [('2020-02-03',1)]
+    assert days[0][2] == len(header) + len(raw_row(0,'2020-02-03 07:00:00.000001'))
+
+
+def test_resume_after_row_completed(tmp_path) :
+    f = str(tmp_path/'buses_data.csv')
+    rows = [raw_row(i,'2020-02-03 23:59:5{}.000001'.format(i)) for i in range(3)] + \
+           [raw_row(i,'2020-02-04 00:00:0{}.000001'.format(i)) for i in range(3,6)]
+    #The last row is half written
+    write_raw(f,rows[:-1] + [rows[-1][:20]])
+    for block_size in [50,10**6] :
+        days = list(read_csv_days_from(f,0,columns,block_size=block_size))
+        assert [(day,day_df.shape[0]) for day,day_df,end in days] == [('2020-02-03',3),('2020-02-04',2)]
+        assert days[1][2] == len(header) + len(''.join(rows[:-1]))
+
+    #Once the row is complete the next read starts after the first day and finds it
+    with open(f,'a') as f_raw :
+        f_raw.write(rows[-1][20:])
+    days = list(read_csv_days_from(f,days[0][2],columns))
+    assert [(day,day_df.shape[0]) for day,day_df,end in days] == [('2020-02-04',3)]
+    assert days[0][1].bus.tolist() == [4002]*3
+    assert days[0][1].estimateArrive.tolist() == [103,104,105]
+    assert days[0][2] == len(header) + len(''.join(rows))
+
+
+def test_read_csv_days(tmp_path) :
+    f = str(tmp_path/'buses_data.csv')
+    rows = [raw_row(i,'2020-02-0{} 12:00:00.000001'.format(3+i//2)) for i in range(6)]
+    write_raw(f,rows)
+    days = list(read_csv_days(f,columns,skip_days={'2020-02-04'}))
+    assert [(day,day_df.shape[0]) for day,day_df in days] == [('2020-02-03',2),('2020-02-05',2)]
+    assert pd.api.types.is_categorical_dtype(days[0][1].line)
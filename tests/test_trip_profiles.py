@@ -0,0 +1,39 @@
+import pandas as pd
+
+from trip_profiles import TripProfiles, headway_stops
+
+
+def times_bt_stops_df(dates) :
+    #Trip times between the first stops of both directions of line 1, at 8 and 9
+    stops1,stops2 = headway_stops('1')
+    rows = []
+    for date in dates :
+        for direction,stops in [(1,stops1),(2,stops2)] :
+            for stopB,stopA in zip(stops[:-1],stops[1:]) :
+                for hour,trip_time in [(8,60.0),(9,90.0)] :
+                    rows.append([date,'1',direction,hour,int(stopA),int(stopB),trip_time])
+    df = pd.DataFrame(rows, columns=['date','line','direction','st_hour','stopA','stopB','trip_time'])
+    df = df.astype({'direction':'uint16','st_hour':'uint16','stopA':'uint16','stopB':'uint16','trip_time':'float32'})
+    df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+def test_build_with_missing_day_types() :
+    #Only a Monday, no data of fridays, saturdays or sundays
+    profiles = TripProfiles.build(times_bt_stops_df(['2020-02-03']))
+    stops1,stops2 = headway_stops('1')
+
+    times = profiles.times_to_stops('1','LA',[8,9])
+    assert len(times) == len(stops1) + len(stops2)
+    assert times[1] == 60.0
+    #Weighted mean of both hours
+    assert profiles.times_to_stops('1','LJ',[8,10])[2] == 150.0
+
+    for day_type in ['VV','SA','FE'] :
+        assert profiles.mean_times('1',day_type,[8,10]) == {}
+        assert profiles.times_to_stops('1',day_type,[8,9]) == [0]
+
+
+def test_build_without_data() :
+    profiles = TripProfiles.build(times_bt_stops_df([]))
+    assert profiles.mean_times('1','LA',[0,24]) == {}